@@ -0,0 +1,163 @@
+# coding=utf-8
+"""
+admin.py
+
+Management commands for heavy catalog operations that should not run inside a web worker.
+
+    python admin.py migrate
+    python admin.py reprice --margin 0.25 --currency NGN --instance <instance id>
+    python admin.py import-catalog catalog.csv --user <user id> --instance <instance id>
+    python admin.py export-catalog catalog.ndjson.gz
+    python admin.py set-fx-rate USD 1450.5
+
+Any of them can also be queued and run by the background workers:
+
+    python admin.py enqueue reprice margin=0.25 currency=NGN instance_id=<instance id>
+    python admin.py enqueue archive_deleted older_than_days=30
+    python admin.py worker --concurrency 4
+"""
+
+import os
+import json
+
+import click
+
+
+@click.group()
+@click.pass_context
+def cli(ctx):
+    """ catalog management commands """
+    import settings
+    from src.base import log
+
+    log.configure(settings)
+    # the worker pool must not connect before forking, its processes apply the migrations themselves
+    if ctx.invoked_subcommand not in ("worker", "migrate"):
+        from src.base import migrations
+
+        migrations.apply()
+
+
+@cli.command()
+def migrate():
+    """ apply the pending data migrations, run this on every deploy """
+    from src.base import migrations
+
+    click.echo(json.dumps(migrations.apply()))
+
+
+@cli.command()
+@click.option("--margin", type=float, default=None, help="profit margin on cost, defaults to each price's own")
+@click.option("--discount", type=float, default=None, help="discount on selling value, defaults to current ratio")
+@click.option("--fx-rate", type=float, default=None,
+              help="multiplier from the cost currency to the price currency, defaults to each price's own")
+@click.option("--currency", default=None, help="only reprice prices in this currency code")
+@click.option("--instance", "instance_id", default=None, help="only reprice the products of this instance")
+@click.option("--batch-size", type=int, default=1000)
+def reprice(margin, discount, fx_rate, currency, instance_id, batch_size):
+    """ recompute product and variant prices in bulk """
+    from src.jobs.repricing import reprice as run
+
+    stats = run(margin=margin, discount=discount, fx_rate=fx_rate, currency=currency, instance_id=instance_id,
+                batch_size=batch_size, progress=lambda s: click.echo(json.dumps(s), err=True))
+    click.echo(json.dumps(stats))
+
+
+@cli.command("import-catalog")
+@click.argument("path")
+@click.option("--user", "user_id", required=True, help="id of the seller the products belong to")
+@click.option("--instance", "instance_id", required=True, help="instance whose category codes are used")
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default=None)
+@click.option("--workers", type=int, default=None, help="validation processes, defaults to the number of cpus")
+@click.option("--batch-size", type=int, default=1000)
+@click.option("--report", default=None, help="write per row errors to this ndjson file")
+def import_catalog(path, user_id, instance_id, fmt, workers, batch_size, report):
+    """ import a csv or ndjson product catalog, upserting by sku """
+    from src.jobs.catalog_import import CatalogImport, open_rows
+
+    job = CatalogImport(user_id, instance_id, batch_size=batch_size, workers=workers, report=report,
+                        progress=lambda s: click.echo(json.dumps(s), err=True))
+    stats = job.run(open_rows(path, fmt=fmt))
+    click.echo(json.dumps(stats))
+
+
+@cli.command("set-fx-rate")
+@click.argument("currency")
+@click.argument("rate", type=float)
+def set_fx_rate(currency, rate):
+    """ record the rate of a currency to BASE_CURRENCY and queue the recompute of normalized prices """
+    from src.services.fx import FxService
+
+    job = FxService.set_rate(currency, rate)
+    click.echo(str(job.pk))
+
+
+@cli.command("normalize-prices")
+@click.option("--currency", default=None, help="only products priced in this currency code")
+@click.option("--batch-size", type=int, default=1000)
+def normalize_prices(currency, batch_size):
+    """ recompute the base currency prices used to sort and filter listings by price """
+    from src.jobs.normalization import normalize_prices as run
+
+    stats = run(currency=currency, batch_size=batch_size, progress=lambda s: click.echo(json.dumps(s), err=True))
+    click.echo(json.dumps(stats))
+
+
+@cli.command("export-catalog")
+@click.argument("path")
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default="ndjson")
+@click.option("--user", "user_id", default=None, help="only export the products of this seller")
+@click.option("--instance", "instance_id", default=None, help="only export the products of this instance")
+@click.option("--batch-size", type=int, default=1000)
+@click.option("--restart", is_flag=True, help="start over instead of resuming an interrupted export")
+def export_catalog(path, fmt, user_id, instance_id, batch_size, restart):
+    """ export products to a csv or ndjson file, gzip compressed when path ends with .gz """
+    from bson.objectid import ObjectId
+    from src.jobs.catalog_export import CatalogExport
+
+    query = {}
+    if instance_id:
+        query["instance_id"] = instance_id
+    if user_id:
+        query["user"] = ObjectId(user_id)
+    stats = CatalogExport(fmt=fmt, query=query, batch_size=batch_size).to_file(path, resume=not restart)
+    click.echo(json.dumps(stats))
+
+
+@cli.command()
+@click.argument("name")
+@click.argument("params", nargs=-1)
+@click.option("--user", "user_id", default=None, help="owner of the job, who can follow it on /jobs")
+@click.option("--max-attempts", type=int, default=3)
+def enqueue(name, params, user_id, max_attempts):
+    """ queue a background job, params are given as key=value with json values """
+    from src.jobs.worker import JOBS
+    from src.services.job import JobService
+
+    if name not in JOBS:
+        raise click.BadParameter("unknown job, expected one of {}".format(", ".join(JOBS)), param_hint="name")
+
+    kwargs = {}
+    for param in params:
+        key, _, value = param.partition("=")
+        try:
+            kwargs[key] = json.loads(value)
+        except ValueError:
+            kwargs[key] = value
+
+    job = JobService.enqueue(name, params=kwargs, user_id=user_id, max_attempts=max_attempts)
+    click.echo(str(job.pk))
+
+
+@cli.command()
+@click.option("--concurrency", type=int, default=None, help="worker processes, defaults to JOB_WORKER_CONCURRENCY")
+@click.option("--job", "names", multiple=True, help="only run these jobs")
+def worker(concurrency, names):
+    """ run the background job worker pool """
+    from src.jobs.worker import run_pool
+
+    run_pool(concurrency=concurrency, names=names or None)
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,20 +1,75 @@
-from src.resources.auth import RegisterResource, LoginResource
+from src.resources.auth import RegisterResource, LoginResource, RefreshTokenResource, LogoutResource
+from src.resources.product import ProductResource, ProductEventResource, NearbyProductResource, \
+    ProductExportResource
+from src.resources.location import LocationResource, NearbyResource
+from src.resources.category import CategoryTreeResource
+from src.resources.job import JobResource
+from src.resources.sales import SalesDashboardResource
+from src.resources.cart import CartQuoteResource
 from src.services.user import UserService
+from src.services.product import ProductService
+from src.services.location import LocationService
+from src.services.category import CategoryService
+from src.services.job import JobService
+from src.services.sales import SalesService
 from src.base.middleware import AuthMiddleware
+from src.base import log
+from src.base.ratelimit import RateLimitMiddleware
+from src.base.compression import CompressionMiddleware
+from werkzeug.middleware.proxy_fix import ProxyFix
 import settings
 from src import app
 from src.base.utils import add_resource
 
+log.configure(settings)
+
+# requests are rate limited after authentication so buckets are keyed by user id; login and register hash passwords
+app.wsgi_app = RateLimitMiddleware(app.wsgi_app, settings=settings,
+                                   costs={"/login": 10, "/register": 10, "/token/refresh": 5, "/products/export": 20})
 app.wsgi_app = AuthMiddleware(app.wsgi_app, settings=settings,
-                              ignored_endpoints=["/register", "/login", "/options", "/features",
-                                                 "/apartments"])
+                              ignored_endpoints=["/register", "/login", "/token/refresh", "/options", "/features",
+                                                 "/apartments", "/categories/tree"])
+app.wsgi_app = CompressionMiddleware(app.wsgi_app, settings=settings)
+app.wsgi_app = log.RequestIdMiddleware(app.wsgi_app, settings=settings)
+if settings.TRUSTED_PROXY_HOPS:
+    # REMOTE_ADDR becomes the client address appended by the outermost trusted proxy
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=settings.TRUSTED_PROXY_HOPS)
 
 register = RegisterResource.initiate(serializers=RegisterResource.serializers, service_klass=UserService)
 login = LoginResource.initiate(serializers=LoginResource.serializers, service_klass=UserService)
+refresh_token = RefreshTokenResource.initiate(serializers=RefreshTokenResource.serializers, service_klass=UserService)
+logout = LogoutResource.initiate(serializers=LogoutResource.serializers, service_klass=UserService)
+product = ProductResource.initiate(serializers=ProductResource.serializers, service_klass=ProductService)
+nearby_product = NearbyProductResource.initiate(serializers=NearbyProductResource.serializers,
+                                                service_klass=ProductService)
+location = LocationResource.initiate(serializers=LocationResource.serializers, service_klass=LocationService)
+nearby_location = NearbyResource.initiate(serializers=NearbyResource.serializers, service_klass=LocationService)
+product_export = ProductExportResource.initiate(serializers=ProductExportResource.serializers,
+                                                service_klass=ProductService)
+category_tree = CategoryTreeResource.initiate(serializers=CategoryTreeResource.serializers,
+                                              service_klass=CategoryService)
+job = JobResource.initiate(serializers=JobResource.serializers, service_klass=JobService)
+sales_dashboard = SalesDashboardResource.initiate(serializers=SalesDashboardResource.serializers,
+                                                  service_klass=SalesService)
+cart_quote = CartQuoteResource.initiate(serializers=CartQuoteResource.serializers, service_klass=ProductService)
+product_event = ProductEventResource.initiate(serializers=ProductEventResource.serializers,
+                                              service_klass=ProductService)
 
 
 add_resource(register, '/register')
 add_resource(login, '/login')
+add_resource(refresh_token, '/token/refresh')
+add_resource(logout, '/logout')
+add_resource(product, '/products', '/products/<string:obj_id>')
+add_resource(product_event, '/products/<string:obj_id>/events')
+add_resource(nearby_product, '/products/nearby')
+add_resource(product_export, '/products/export')
+add_resource(location, '/locations', '/locations/<string:obj_id>')
+add_resource(nearby_location, '/locations/nearby')
+add_resource(category_tree, '/categories/tree')
+add_resource(job, '/jobs', '/jobs/<string:obj_id>')
+add_resource(sales_dashboard, '/sales/dashboard')
+add_resource(cart_quote, '/cart/quote')
 
 
 if __name__ == '__main__':
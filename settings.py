@@ -31,6 +31,77 @@ MONGO_DATABASE = os.getenv("MONGO_DATABASE")
 ENV = os.getenv("ENV")
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM")
-JWT_EXPIRES_IN_HOURS = int(os.getenv("JWT_EXPIRES_IN_HOURS", "200"))
+# access tokens are short lived, clients renew them with a refresh token at /token/refresh
+JWT_ACCESS_EXPIRES_IN_MINUTES = int(os.getenv("JWT_ACCESS_EXPIRES_IN_MINUTES", "15"))
+JWT_REFRESH_EXPIRES_IN_DAYS = int(os.getenv("JWT_REFRESH_EXPIRES_IN_DAYS", "30"))
 API_PREFIX = os.getenv("API_PREFIX", "/api/v1")
 
+
+# query result cache for list endpoints: "local" (in-process LRU) or "mongo" (shared by all workers)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local")
+CACHE_DEFAULT_TTL_SECONDS = int(os.getenv("CACHE_DEFAULT_TTL_SECONDS", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+
+# write-behind product stat counters (views, likes, units_sold)
+STATS_FLUSH_INTERVAL_SECONDS = int(os.getenv("STATS_FLUSH_INTERVAL_SECONDS", "5"))
+STATS_FLUSH_THRESHOLD = int(os.getenv("STATS_FLUSH_THRESHOLD", "500"))
+
+# default search radius of nearest store / delivery radius queries
+GEO_DEFAULT_RADIUS_METERS = float(os.getenv("GEO_DEFAULT_RADIUS_METERS", "50000"))
+
+# seconds the category tree of an instance is cached; category writes invalidate it immediately
+CATEGORY_TREE_TTL_SECONDS = int(os.getenv("CATEGORY_TREE_TTL_SECONDS", "300"))
+
+# background job workers
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "2"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_RETRY_BACKOFF_SECONDS = int(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "30"))
+
+# what to do with queries on tenant scoped models that carry no instance_id: "warn", "raise" or "off"
+TENANT_QUERY_GUARD = os.getenv("TENANT_QUERY_GUARD", "warn")
+
+# rate limiting: token buckets per user (or client ip) refilled at RATE_LIMIT_PER_SECOND up to RATE_LIMIT_BURST,
+# "local" (per worker) or "mongo" (shared by all workers). RATE_LIMIT_PER_SECOND=0 disables it.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "local")
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "10"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "50"))
+# number of proxies in front of the app that append to X-Forwarded-For. The client ip is the address the outermost
+# of them saw, earlier entries are sent by the client and not trusted. 0 uses the address of the peer.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+# requests served at once per worker process before shedding with 503, 0 disables the limit. Only meaningful for
+# threaded workers (e.g. gunicorn --threads 8): a sync worker serves one request at a time anyway.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "64"))
+
+# POST responses sent with an Idempotency-Key header are replayed to retries for this long
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# a retry arriving while the first request is still running gets 409 until this lock expires
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+
+# response compression: bodies under COMPRESSION_MIN_SIZE bytes are sent uncompressed. brotli and zstd are only
+# offered when the brotli / zstandard packages are installed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_LEVEL = int(os.getenv("COMPRESSION_BROTLI_LEVEL", "5"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+# compressed forms of responses with an ETag kept per worker, 0 disables the cache
+COMPRESSION_CACHE_ENTRIES = int(os.getenv("COMPRESSION_CACHE_ENTRIES", "256"))
+COMPRESSION_CACHE_TTL_SECONDS = int(os.getenv("COMPRESSION_CACHE_TTL_SECONDS", "300"))
+
+# hourly sales rollups are removed after this many days, daily rollups are kept
+SALES_HOURLY_RETENTION_DAYS = int(os.getenv("SALES_HOURLY_RETENTION_DAYS", "90"))
+
+# seconds between two syncs of the in-memory revoked token set of a worker, i.e. how long a revoked token may still
+# be accepted by another worker
+REVOCATION_SYNC_INTERVAL_SECONDS = int(os.getenv("REVOCATION_SYNC_INTERVAL_SECONDS", "5"))
+
+# logging: root level, per logger levels ("src.base.service=DEBUG,pymongo=WARNING"), "json" or "text" output and
+# sample rates of records below WARNING per logger ("src.access=0.1" keeps one access log line in ten)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "src.access=0.1,src.base.middleware=0.01")
+
+# currency products are normalized to for cross currency price sorting and filtering, see FxRate
+BASE_CURRENCY = os.getenv("BASE_CURRENCY", "NGN")
+FX_RATES_TTL_SECONDS = int(os.getenv("FX_RATES_TTL_SECONDS", "300"))
@@ -0,0 +1,171 @@
+# coding=utf-8
+"""
+cache.py
+
+Versioned cache used in front of list endpoints.
+
+Every model collection has a version counter that is bumped by BaseService on create, update and delete. Cache keys
+embed the current version of every collection a result depends on, so a write makes all older entries unreachable
+without scanning or deleting keys; they simply age out of the LRU or expire.
+
+Backends:
+    - LocalCache: in-process LRU. Versions are per process, so with several workers an entry can be served stale
+      until its ttl runs out. Also the stand-in for the shared store in tests.
+    - MongoCache: shared by all workers, entries and versions live in the application database.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import json
+import threading
+import time
+
+import pymongo
+from pymodm.connection import _get_db
+
+import settings
+from . import utils
+
+
+class LocalCache(object):
+    """ thread safe in-process LRU cache with per entry expiry """
+
+    def __init__(self, max_entries=1024, default_ttl=60):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.default_ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_versions(self, namespaces):
+        with self._lock:
+            return [self._versions.get(namespace, 0) for namespace in namespaces]
+
+    def bump_version(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            return self._versions[namespace]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class MongoCache(object):
+    """ cache shared by all workers. Expired entries are removed by a TTL index """
+
+    def __init__(self, collection_name="cache_entries", versions_collection_name="cache_versions", default_ttl=60):
+        self.collection_name = collection_name
+        self.versions_collection_name = versions_collection_name
+        self.default_ttl = default_ttl
+        self._indexed = False
+
+    @property
+    def collection(self):
+        collection = _get_db()[self.collection_name]
+        if not self._indexed:
+            collection.create_index([("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    @property
+    def versions(self):
+        return _get_db()[self.versions_collection_name]
+
+    def get(self, key):
+        doc = self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}}, {"value": 1})
+        if not doc:
+            return None
+        return json.loads(doc["value"])
+
+    def set(self, key, value, ttl=None):
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl or self.default_ttl)
+        self.collection.replace_one({"_id": key}, {"value": utils.convert_dict(value), "expires_at": expires_at},
+                                    upsert=True)
+
+    def delete(self, key):
+        self.collection.delete_one({"_id": key})
+
+    def get_versions(self, namespaces):
+        found = {doc["_id"]: doc.get("version", 0)
+                 for doc in self.versions.find({"_id": {"$in": list(namespaces)}})}
+        return [found.get(namespace, 0) for namespace in namespaces]
+
+    def bump_version(self, namespace):
+        doc = self.versions.find_one_and_update({"_id": namespace}, {"$inc": {"version": 1}}, upsert=True,
+                                                return_document=pymongo.ReturnDocument.AFTER)
+        return doc["version"]
+
+    def clear(self):
+        self.collection.delete_many({})
+        self.versions.delete_many({})
+
+
+_cache = None
+
+
+def get_cache():
+    """ the cache backend configured in settings, created on first use """
+    global _cache
+    if _cache is None:
+        if settings.CACHE_BACKEND == "mongo":
+            _cache = MongoCache(default_ttl=settings.CACHE_DEFAULT_TTL_SECONDS)
+        else:
+            _cache = LocalCache(max_entries=settings.CACHE_MAX_ENTRIES,
+                                default_ttl=settings.CACHE_DEFAULT_TTL_SECONDS)
+    return _cache
+
+
+def set_cache(backend):
+    """ replace the cache backend, e.g. with a LocalCache in tests """
+    global _cache
+    _cache = backend
+
+
+def namespace(model_class):
+    """ the version namespace of a model is its collection """
+    return model_class._mongometa.collection_name
+
+
+def invalidate(model_class):
+    """ invalidate every cached result that depends on model_class """
+    return get_cache().bump_version(namespace(model_class))
+
+
+def make_key(*parts, models=None):
+    """
+    build a cache key from the parts that identify a result and the current versions of the models it depends on
+
+    :param parts: json serializable values, e.g. resource name, query params, user id
+    :param models: model classes the cached result is built from
+    :return: str
+    """
+    namespaces = [namespace(model) for model in models or []]
+    versions = get_cache().get_versions(namespaces) if namespaces else []
+    raw = json.dumps([parts, list(zip(namespaces, versions))], sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
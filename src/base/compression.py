@@ -0,0 +1,233 @@
+# coding=utf-8
+"""
+compression.py
+
+Response compression negotiated per request.
+
+The encoding is picked from Accept-Encoding among those available: brotli and zstd when their libraries (brotli,
+zstandard) are installed, gzip always. Only text like content types are compressed, bodies under
+COMPRESSION_MIN_SIZE bytes are sent as they are. Streamed responses are compressed chunk by chunk and flushed after
+every chunk, so they still reach the client incrementally. Compressed forms of responses carrying an ETag are kept
+in an in-process LRU keyed by encoding and body digest, so identical pages are not compressed again.
+"""
+import gzip
+import hashlib
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+from .cache import LocalCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript", "application/xml",
+                      "text/")
+
+
+class GzipEncoder(object):
+    name = "gzip"
+
+    def __init__(self, level):
+        self.level = level
+        self._stream = None
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def chunk(self, data):
+        if self._stream is None:
+            self._stream = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return self._stream.compress(data) + self._stream.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._stream.flush() if self._stream else b""
+
+
+class BrotliEncoder(object):
+    name = "br"
+
+    def __init__(self, level):
+        self.level = level
+        self._stream = None
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+    def chunk(self, data):
+        if self._stream is None:
+            self._stream = brotli.Compressor(quality=self.level)
+        return self._stream.process(data) + self._stream.flush()
+
+    def finish(self):
+        return self._stream.finish() if self._stream else b""
+
+
+class ZstdEncoder(object):
+    name = "zstd"
+
+    def __init__(self, level):
+        self.level = level
+        self._stream = None
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def chunk(self, data):
+        if self._stream is None:
+            self._stream = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return self._stream.compress(data) + self._stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._stream.flush() if self._stream else b""
+
+
+def available_encoders(settings):
+    """ encoding name -> encoder factory, in order of preference """
+    encoders = {}
+    if brotli is not None:
+        encoders["br"] = lambda: BrotliEncoder(settings.COMPRESSION_BROTLI_LEVEL)
+    if zstandard is not None:
+        encoders["zstd"] = lambda: ZstdEncoder(settings.COMPRESSION_ZSTD_LEVEL)
+    encoders["gzip"] = lambda: GzipEncoder(settings.COMPRESSION_GZIP_LEVEL)
+    return encoders
+
+
+class CompressionMiddleware(object):
+    """
+    WSGI middleware compressing responses. Sits outside every other middleware so error responses are compressed
+    too.
+    """
+
+    def __init__(self, app, settings, encoders=None):
+        """
+
+        :param app: the wsgi app
+        :param settings: settings module
+        :param encoders: encoding name -> encoder factory, defaults to available_encoders
+        """
+        self.app = app
+        self.settings = settings
+        self.min_size = settings.COMPRESSION_MIN_SIZE
+        self.encoders = encoders or available_encoders(settings)
+        self.cache = LocalCache(max_entries=settings.COMPRESSION_CACHE_ENTRIES,
+                                default_ttl=settings.COMPRESSION_CACHE_TTL_SECONDS) \
+            if settings.COMPRESSION_CACHE_ENTRIES else None
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return lambda data: None
+
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+
+        if not self.is_compressible(environ, status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        vary = headers.get("Vary")
+        headers["Vary"] = vary + ", Accept-Encoding" if vary else "Accept-Encoding"
+        if not encoding:
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        # a body with a known length is complete, streamed ones are read just enough to know whether they are worth
+        # compressing
+        chunks, size, iterator = [], 0, iter(app_iter)
+        exhausted = False
+        while size < self.min_size or "Content-Length" in headers:
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                exhausted = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+
+        if exhausted:
+            body = b"".join(chunks)
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            if size >= self.min_size:
+                body = self.compress_body(encoding, body, cacheable="ETag" in headers)
+                self.set_encoding(headers, encoding)
+            headers["Content-Length"] = str(len(body))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [body]
+
+        self.set_encoding(headers, encoding)
+        headers.remove("Content-Length")
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return self.compress_stream(self.encoders[encoding](), chunks, iterator, app_iter)
+
+    def negotiate(self, accept_encoding):
+        """ the preferred available encoding accepted by the client, or None """
+        if not accept_encoding:
+            return None
+        accepted = parse_accept_header(accept_encoding)
+        best, best_quality = None, 0
+        for name in self.encoders:
+            quality = accepted[name]
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    def is_compressible(self, environ, status, headers):
+        if environ.get("REQUEST_METHOD") == "HEAD" or status[:3] in ("204", "304") or status[0] == "1":
+            return False
+        if "Content-Encoding" in headers or "no-transform" in headers.get("Cache-Control", ""):
+            return False
+        content_type = headers.get("Content-Type", "")
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        content_length = headers.get("Content-Length")
+        return not (content_length and content_length.isdigit() and int(content_length) < self.min_size)
+
+    @staticmethod
+    def set_encoding(headers, encoding):
+        headers["Content-Encoding"] = encoding
+        # a strong etag identifies the exact bytes, which the encoding changes
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = "W/" + etag
+
+    def compress_body(self, encoding, body, cacheable=False):
+        """ compress a complete body, reusing the compressed form of responses seen before """
+        if not (cacheable and self.cache):
+            return self.encoders[encoding]().compress(body)
+
+        key = "{}:{}".format(encoding, hashlib.sha1(body).hexdigest())
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = self.encoders[encoding]().compress(body)
+            self.cache.set(key, compressed)
+        return compressed
+
+    @staticmethod
+    def compress_stream(encoder, chunks, iterator, app_iter):
+        try:
+            data = encoder.chunk(b"".join(chunks))
+            if data:
+                yield data
+            for chunk in iterator:
+                data = encoder.chunk(chunk)
+                if data:
+                    yield data
+            yield encoder.finish()
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
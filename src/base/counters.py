@@ -0,0 +1,143 @@
+# coding=utf-8
+"""
+counters.py
+
+Write-behind counters. Increments are accumulated in memory per worker, coalesced by object id and written as one
+unordered bulk_write of $inc operations, either periodically from a background thread or once the number of pending
+objects reaches a threshold. At most flush_interval seconds of increments can be lost if a worker dies; a normal
+shutdown flushes what is pending.
+"""
+from collections import Counter, defaultdict
+import atexit
+import logging
+import os
+import threading
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError, BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+# write error codes worth retrying: the operation may succeed once the primary is back or the conflict is gone
+TRANSIENT_ERRORS = {6, 7, 50, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+
+class BufferedCounter(object):
+    """ buffers $inc updates for the documents of a single model """
+
+    def __init__(self, model_class, fields, flush_interval=5, flush_threshold=500, max_pending=50000):
+        """
+
+        :param model_class: the model whose collection is updated
+        :param fields: mongo field names that may be incremented, e.g. "stats.views"
+        :param flush_interval: seconds between background flushes
+        :param flush_threshold: number of pending objects that triggers an immediate flush
+        :param max_pending: pending objects kept for a retry when a flush fails, anything above is dropped
+        """
+        self.model_class = model_class
+        self.fields = set(fields)
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.max_pending = max_pending
+        self._reset()
+        atexit.register(self.stop)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pending = defaultdict(Counter)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _ensure_flusher(self):
+        """ start the flush thread in the current process. Workers forked after import get their own buffer """
+        if self._pid != os.getpid():
+            self._reset()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="buffered-counter-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except PyMongoError:
+                # the increments are back in the buffer, the next tick retries
+                pass
+            except Exception:
+                # keep the thread alive, a dead flusher would silently stop every counter of the worker
+                logger.exception("counter flush failed")
+
+    def incr(self, obj_id, field, amount=1):
+        """
+        add amount to field of the object, the write happens on the next flush
+
+        :param obj_id: _id of the document
+        :param field: one of the configured fields
+        :param amount: value to add, may be negative
+        """
+        if field not in self.fields:
+            raise ValueError("{} is not a buffered field".format(field))
+
+        self._ensure_flusher()
+        with self._lock:
+            self._pending[obj_id][field] += amount
+            size = len(self._pending)
+
+        if size >= self.flush_threshold:
+            try:
+                self.flush()
+            except PyMongoError as e:
+                # the increments are back in the buffer, counting must never fail the request
+                logger.warning("counter flush failed: %s", e)
+
+    def flush(self):
+        """
+        write every pending increment in a single unordered bulk_write
+
+        :return: number of documents updated
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(Counter)
+
+        pending = [(obj_id, counts) for obj_id, counts in pending.items() if any(counts.values())]
+        if not pending:
+            return 0
+
+        operations = [UpdateOne({"_id": obj_id}, {"$inc": dict(counts)}) for obj_id, counts in pending]
+        try:
+            self.model_class._mongometa.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # the other operations of an unordered bulk_write were applied, only the failed ones are retried, and only
+            # when retrying can help: a permanent failure (e.g. $inc on a non numeric field) would fail every flush
+            retried = set()
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") in TRANSIENT_ERRORS:
+                    retried.add(error["index"])
+                else:
+                    obj_id, counts = pending[error["index"]]
+                    logger.error("dropped counter increments %s of %s: %s", dict(counts), obj_id,
+                                 error.get("errmsg"))
+            self._restore([item for index, item in enumerate(pending) if index in retried])
+            raise
+        except PyMongoError:
+            self._restore(pending)
+            raise
+        return len(operations)
+
+    def _restore(self, pending):
+        """ merge increments of a failed flush back into the buffer """
+        with self._lock:
+            for obj_id, counts in pending:
+                if obj_id not in self._pending and len(self._pending) >= self.max_pending:
+                    continue
+                self._pending[obj_id].update(counts)
+
+    def stop(self):
+        """ stop the flush thread and write what is pending """
+        self._stopped.set()
+        if self._pid == os.getpid():
+            try:
+                self.flush()
+            except PyMongoError:
+                pass
@@ -0,0 +1,107 @@
+# coding=utf-8
+"""
+idempotency.py
+
+Idempotency-Key support for POST requests.
+
+The first request with a given key inserts an in-flight record, which acts as a lock: a retry arriving while the
+first request still runs is answered with 409 instead of creating a duplicate. Once the request succeeds its status
+body and headers are stored on the record and every retry within IDEMPOTENCY_TTL_SECONDS gets them back without reaching
+the service layer. A request that fails releases the key, so the retry runs again. Keys are scoped to the user (or
+tenant for anonymous requests) and the path, and bound to the request body: reusing a key for a different body is
+refused with 422.
+"""
+from datetime import datetime, timedelta
+import hashlib
+import json
+
+from flask import request, abort
+from flask_restful.utils import unpack
+from pymongo.errors import DuplicateKeyError
+from werkzeug.datastructures import Headers
+
+import settings
+from . import utils
+from ..models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+
+
+def scoped_key(key):
+    """ the stored key of the current request: the client key, scoped to the caller and the endpoint """
+    user_context = request.environ.get("user_context") or {}
+    scope = [user_context.get("id") or "", request.environ.get("instance_id") or "", request.path, key]
+    return hashlib.sha1(json.dumps(scope).encode("utf-8")).hexdigest()
+
+
+def fingerprint():
+    """ digest of the current request body """
+    return hashlib.sha1(request.get_data()).hexdigest()
+
+
+def _acquire(key, digest):
+    """
+    insert the in-flight record of key, or take over one whose lock expired
+
+    :return: None when the caller should run the request, otherwise the existing record
+    """
+    collection = IdempotencyKey._mongometa.collection
+    while True:
+        now = datetime.utcnow()
+        locked_until = now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS)
+        try:
+            collection.insert_one({"_id": key, "fingerprint": digest, "status": IdempotencyKey.IN_FLIGHT,
+                                   "locked_until": locked_until, "date_created": now,
+                                   "expires_at": now + timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS)})
+            return None
+        except DuplicateKeyError:
+            pass
+
+        # the first request died without releasing the key
+        taken = collection.find_one_and_update({"_id": key, "fingerprint": digest,
+                                                "status": IdempotencyKey.IN_FLIGHT, "locked_until": {"$lt": now}},
+                                               {"$set": {"locked_until": locked_until}})
+        if taken:
+            return None
+        record = collection.find_one({"_id": key})
+        if record:
+            return record
+        # the record expired or was released (its request failed) since the insert, try again
+
+
+def run(key, handler):
+    """
+    run handler once per key and replay its outcome to retries
+
+    :param key: the Idempotency-Key sent by the client
+    :param handler: callable returning the response of a successful request: a body, or a (body, status code) or
+        (body, status code, headers) tuple as resource methods return
+    :return: (body, status code, headers)
+    """
+    if len(key) > 255:
+        abort(400, {"desc": "{} is too long".format(HEADER)})
+
+    key, digest = scoped_key(key), fingerprint()
+    record = _acquire(key, digest)
+    if record is not None:
+        if record.get("fingerprint") != digest:
+            abort(422, {"desc": "{} was already used for a different request".format(HEADER)})
+        if record.get("status") != IdempotencyKey.COMPLETED:
+            abort(409, {"desc": "a request with this {} is still in progress".format(HEADER)})
+        headers = Headers(record.get("headers") or [])
+        headers["Idempotent-Replayed"] = "true"
+        return json.loads(record["body"]), record["status_code"], headers
+
+    collection = IdempotencyKey._mongometa.collection
+    try:
+        body, status_code, headers = unpack(handler())
+    except BaseException:
+        collection.delete_one({"_id": key, "status": IdempotencyKey.IN_FLIGHT})
+        raise
+
+    headers = Headers(headers or {})
+    collection.update_one({"_id": key}, {"$set": {"status": IdempotencyKey.COMPLETED, "status_code": status_code,
+                                                  "body": utils.convert_dict(body),
+                                                  "headers": [list(header) for header in headers.items()]},
+                                         "$unset": {"locked_until": ""}})
+    return body, status_code, headers
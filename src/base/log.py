@@ -0,0 +1,199 @@
+# coding=utf-8
+"""
+log.py
+
+Structured, non-blocking logging.
+
+configure() routes every logger through a QueueHandler: the calling thread only stamps the record with the request
+id and tenant, samples it and puts it on a queue, a QueueListener thread formats the records (one JSON object per
+line by default) and writes them to stdout. Levels are set per logger with LOG_LEVELS, e.g.
+"src.base.service=DEBUG,pymongo=WARNING". Records below WARNING from noisy loggers are sampled with
+LOG_SAMPLE_RATES, e.g. "src.access=0.1" keeps one access log line in ten; warnings and errors are always kept.
+
+RequestIdMiddleware gives every request an id, taken from a sane X-Request-Id header or generated, which is added
+to every record logged while serving it and returned in the X-Request-Id response header.
+"""
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+
+from . import tenant
+
+_request_id = ContextVar("request_id", default=None)
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._\-]{1,128}$")
+
+# attributes every LogRecord has, anything else was passed with extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id",
+                                                                                   "instance_id"}
+
+access_logger = logging.getLogger("src.access")
+
+
+def get_request_id():
+    """ id of the request being served, None outside of requests """
+    return _request_id.get()
+
+
+def parse_mapping(value, convert=str):
+    """ "a=1,b=2" -> {"a": convert("1"), "b": convert("2")} """
+    mapping = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, _, setting = item.partition("=")
+            mapping[name.strip()] = convert(setting.strip())
+    return mapping
+
+
+class ContextFilter(logging.Filter):
+    """ stamps records with the request id and tenant of the thread logging them """
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        record.instance_id = tenant.get_instance_id()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """ keeps a fraction of the records below WARNING of the configured loggers (and their children) """
+
+    def __init__(self, rates):
+        super(SamplingFilter, self).__init__()
+        self.rates = rates
+        self._resolved = {}
+
+    def rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1.0
+            parts = name.split(".")
+            for i in range(len(parts), 0, -1):
+                prefix = ".".join(parts[:i])
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """ one JSON object per record """
+
+    def format(self, record):
+        data = {"ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage()}
+        for name in ("request_id", "instance_id"):
+            if getattr(record, name, None):
+                data[name] = getattr(record, name)
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """ enqueues records as they are, leaving the formatting to the listener thread """
+
+    def prepare(self, record):
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+_queue_handler = None
+
+
+def _start_listener(settings):
+    global _listener
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if settings.LOG_FORMAT == "json" else logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+
+
+def configure(settings):
+    """ install the queue handler on the root logger and start the listener thread. Safe to call more than once """
+    global _queue_handler
+    if _queue_handler is not None:
+        return
+
+    _queue_handler = QueueHandler(queue.SimpleQueue())
+    _queue_handler.addFilter(ContextFilter())
+    _queue_handler.addFilter(SamplingFilter(parse_mapping(settings.LOG_SAMPLE_RATES, float)))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(settings.LOG_LEVEL.upper())
+    for name, level in parse_mapping(settings.LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    _start_listener(settings)
+    atexit.register(stop)
+    # the listener thread does not survive a fork, forked processes (job workers) start their own
+    os.register_at_fork(after_in_child=lambda: _start_listener(settings))
+
+
+def stop():
+    """ write out the queued records and stop the listener thread """
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+class RequestIdMiddleware(object):
+    """
+    WSGI middleware assigning the request id and writing the access log. Outermost, so every other middleware logs
+    with the request id.
+    """
+
+    def __init__(self, app, settings):
+        self.app = app
+        self.settings = settings
+
+    def __call__(self, environ, start_response):
+        request_id = environ.get("HTTP_X_REQUEST_ID", "")
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+        environ["request_id"] = request_id
+        # each request runs from start to end on one thread, the next request on it sets its own id
+        _request_id.set(request_id)
+        started = time.monotonic()
+
+        def start(status, headers, exc_info=None):
+            headers.append(("X-Request-Id", request_id))
+            if access_logger.isEnabledFor(logging.INFO):
+                access_logger.info("%s %s %s", environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"), status[:3],
+                                   extra={"status": int(status[:3]),
+                                          "duration_ms": round((time.monotonic() - started) * 1000, 1)})
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, start)
@@ -1,5 +1,10 @@
 from werkzeug.wrappers import Request, Response
 import jwt
+import logging
+
+from .revocation import get_revocations
+
+logger = logging.getLogger(__name__)
 
 
 class AuthMiddleware(object):
@@ -7,10 +12,11 @@ class AuthMiddleware(object):
     Simple WSGI middleware
     '''
 
-    def __init__(self, app, settings, ignored_endpoints=None):
+    def __init__(self, app, settings, ignored_endpoints=None, revocations=None):
         self.app = app
         self.ignored_endpoints = ignored_endpoints
         self.settings = settings
+        self.revocations = revocations or get_revocations()
 
     def __call__(self, environ, start_response):
 
@@ -21,8 +27,19 @@ class AuthMiddleware(object):
             return res(environ, start_response)
 
         environ['user_context'] = user_context
+        environ['instance_id'] = self.resolve_tenant(request, user_context)
         return self.app(environ, start_response)
 
+    def resolve_tenant(self, request, user_context):
+        """
+        The tenant (instance_id) of the request. Authenticated requests belong to the tenant of their token, a user
+        without one stays without one whatever the client sends; the X-Instance-Id header only serves
+        unauthenticated endpoints such as /register or /login.
+        """
+        if user_context:
+            return user_context.get("instance_id") or None
+        return request.headers.get("X-Instance-Id") or None
+
     def validate_token(self, token):
         """
 
@@ -31,12 +48,17 @@ class AuthMiddleware(object):
         :return:
         :rtype:
         """
+        if not token:
+            return None
         try:
             token = token.split("Bearer ")[1]
             data = jwt.decode(token, self.settings.JWT_SECRET_KEY, algorithms=self.settings.JWT_ALGORITHM)
+            # refresh tokens, and tokens issued before they could be revoked, do not grant access
+            if data.get("type") != "access" or not data.get("jti") or self.revocations.is_revoked(data):
+                return None
             return data
         except Exception as e:
-            print(e)
+            logger.debug("rejected token: %s", e)
         return None
 
     def check_ignored_endpoints(self, path, base_path=''):
@@ -0,0 +1,75 @@
+# coding=utf-8
+"""
+migrations.py
+
+Data migrations the code depends on, applied before anything is served.
+
+The live filter and the partial indexes match {"deleted": False}, so documents written before soft delete existed
+are invisible until backfilled; likewise locations saved before Location.point existed are missed by every distance
+query until it is set from their lat/lng. apply() runs every migration not yet recorded in the migration collection, records
+it, and is then a no-op for the rest of the process. It runs on the first service lookup of a web worker, when a job
+worker starts and before admin commands, or explicitly with
+
+    python admin.py migrate
+
+which is the step to run while deploying, so no request waits on a long backfill. Migrations are idempotent, two
+processes applying the same one at once is harmless.
+"""
+from datetime import datetime
+import logging
+import threading
+
+from ..models import Migration
+
+logger = logging.getLogger(__name__)
+
+
+def _soft_delete_backfill():
+    from ..jobs.archival import backfill
+
+    return backfill()
+
+
+def _location_point_backfill():
+    from ..services.location import LocationService
+
+    return {"locations": LocationService.backfill_points()}
+
+
+# (name, function) in the order they are applied
+MIGRATIONS = [
+    ("soft_delete_backfill", _soft_delete_backfill),
+    ("location_point_backfill", _location_point_backfill),
+]
+
+_applied = False
+_lock = threading.Lock()
+
+
+def apply():
+    """
+    apply the pending migrations
+
+    :return: names of the migrations applied by this call
+    """
+    global _applied
+    if _applied:
+        return []
+    with _lock:
+        if _applied:
+            return []
+        collection = Migration._mongometa.collection
+        done = {doc["_id"] for doc in collection.find({}, projection={"_id": 1})}
+        applied = []
+        for name, func in MIGRATIONS:
+            if name in done:
+                continue
+            logger.info("applying migration %s", name)
+            result = func()
+            collection.update_one({"_id": name},
+                                  {"$set": {"result": result or {}, "applied_at": datetime.utcnow()},
+                                   "$setOnInsert": {"_cls": Migration._mongometa.object_name}},
+                                  upsert=True)
+            applied.append(name)
+        _applied = True
+        return applied
@@ -0,0 +1,160 @@
+# coding=utf-8
+"""
+ratelimit.py
+
+Rate limiting and admission control.
+
+Each client (the user id of a valid token, or the client ip) owns a token bucket that refills at RATE_LIMIT_PER_SECOND
+up to RATE_LIMIT_BURST tokens. A request takes as many tokens as its endpoint costs, so expensive endpoints such as
+/login (bcrypt) drain a bucket faster. Requests without enough tokens are refused with 429 before reaching the app.
+On top of that, a per worker concurrency limit sheds load with 503 once MAX_CONCURRENT_REQUESTS requests are in
+flight, instead of letting them queue up. The limit counts the threads of one process, so it only applies to threaded
+workers; with gunicorn sync workers each process serves a single request at a time and the backlog queues in the
+listen socket, bounded by gunicorn's --backlog.
+
+The client ip is REMOTE_ADDR. Behind proxies, app.py applies ProxyFix with TRUSTED_PROXY_HOPS so REMOTE_ADDR is the
+address seen by the outermost trusted proxy, not an X-Forwarded-For entry the client could choose.
+
+Backends:
+    - LocalBucketStore: buckets in process memory, per worker. Also the stand-in for the shared store in tests.
+    - MongoBucketStore: buckets shared by all workers, refilled and taken atomically in a single update.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+
+import pymongo
+from pymodm.connection import _get_db
+from werkzeug.wrappers import Request, Response
+from werkzeug.wsgi import ClosingIterator
+
+
+class LocalBucketStore(object):
+    """ token buckets in process memory, the least recently used are dropped beyond max_keys """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, rate, capacity):
+        """
+        refill the bucket of key and take cost tokens from it
+
+        :return: (allowed, seconds until enough tokens are available)
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+
+class MongoBucketStore(object):
+    """ token buckets shared by all workers. Idle buckets are removed by a TTL index """
+
+    def __init__(self, collection_name="rate_limits", idle_seconds=3600):
+        self.collection_name = collection_name
+        self.idle_seconds = idle_seconds
+        self._indexed = False
+
+    @property
+    def collection(self):
+        collection = _get_db()[self.collection_name]
+        if not self._indexed:
+            collection.create_index([("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    def take(self, key, cost, rate, capacity):
+        now = time.time()
+        refilled = {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]},
+                                                 {"$multiply": [{"$subtract": [now, {"$ifNull": ["$ts", now]}]},
+                                                                rate]}]}]}
+        doc = self.collection.find_one_and_update(
+            {"_id": key},
+            [{"$set": {"tokens": refilled, "ts": now,
+                       "expires_at": datetime.utcnow() + timedelta(seconds=self.idle_seconds)}},
+             {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+             {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]}}}],
+            upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        allowed = doc["allowed"]
+        return allowed, 0 if allowed else (cost - doc["tokens"]) / rate
+
+
+class RateLimitMiddleware(object):
+    """
+    WSGI middleware applying the token buckets and the concurrency limit. Wrapped by AuthMiddleware, so the user
+    context of a valid token is already in the environ.
+    """
+
+    def __init__(self, app, settings, store=None, costs=None):
+        """
+
+        :param app: the wsgi app
+        :param settings: settings module
+        :param store: bucket store, defaults to the one selected by RATE_LIMIT_BACKEND
+        :param costs: tokens taken by a request per path prefix (relative to API_PREFIX), 1 otherwise
+        """
+        self.app = app
+        self.settings = settings
+        self.rate = settings.RATE_LIMIT_PER_SECOND
+        self.capacity = settings.RATE_LIMIT_BURST
+        self.costs = sorted((costs or {}).items(), key=lambda item: len(item[0]), reverse=True)
+        if store is None:
+            store = MongoBucketStore() if settings.RATE_LIMIT_BACKEND == "mongo" else LocalBucketStore()
+        self.store = store
+        self.concurrency = threading.BoundedSemaphore(settings.MAX_CONCURRENT_REQUESTS) \
+            if settings.MAX_CONCURRENT_REQUESTS else None
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+
+        if self.rate:
+            allowed, retry_after = self.store.take(self.client_key(request), self.cost(request.path),
+                                                   self.rate, self.capacity)
+            if not allowed:
+                return self.reject(environ, start_response, 429, "rate limit exceeded", retry_after)
+
+        if self.concurrency is None:
+            return self.app(environ, start_response)
+
+        if not self.concurrency.acquire(blocking=False):
+            return self.reject(environ, start_response, 503, "server busy", 1)
+        try:
+            app_iter = self.app(environ, start_response)
+        except Exception:
+            self.concurrency.release()
+            raise
+        # streamed responses hold their slot until they are fully sent
+        return ClosingIterator(app_iter, [self.concurrency.release])
+
+    def client_key(self, request):
+        """ the user id of a valid token, or the client ip """
+        user_context = request.environ.get("user_context")
+        if user_context and user_context.get("id"):
+            return "user:{}".format(user_context.get("id"))
+        return "ip:{}".format(request.remote_addr)
+
+    def cost(self, path):
+        """ tokens taken by a request to path """
+        base_path = self.settings.API_PREFIX or ""
+        relative_path = path[len(base_path):] if path.startswith(base_path) else path
+        for prefix, cost in self.costs:
+            if relative_path.startswith(prefix):
+                return cost
+        return 1
+
+    @staticmethod
+    def reject(environ, start_response, status, desc, retry_after):
+        res = Response(json.dumps({"desc": desc}), content_type='application/json', status=status,
+                       headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+        return res(environ, start_response)
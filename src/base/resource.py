@@ -1,10 +1,35 @@
 from flask_restful import Resource
 from flask import request, make_response, abort
 from marshmallow import EXCLUDE, ValidationError
+from werkzeug.http import http_date, quote_etag
+from datetime import datetime, timezone
+import hashlib
+import logging
+
+from . import cache, idempotency, tenant
+
+logger = logging.getLogger(__name__)
 
 
 class BaseResource(Resource):
 
+    # Cache-Control sent with every GET response of this resource. Responses are limited to the requesting user by
+    # default, so shared caches must not keep them; override per resource for public catalog data.
+    cache_control = "private, no-cache"
+
+    # request headers a GET response depends on, sent as Vary so shared caches keep one copy per value
+    vary = None
+
+    # seconds a list response is kept in the query result cache, None disables caching for the resource
+    cache_timeout = None
+
+    # models a list response is built from; a write to any of them invalidates the cached list.
+    # Defaults to the model of service_klass
+    cache_dependencies = None
+
+    # replay the response of a POST retried with the same Idempotency-Key header instead of running it again
+    idempotent = True
+
     def __init__(self):
         """
 
@@ -12,7 +37,7 @@ class BaseResource(Resource):
 
     def query(self):
         """this is the query that to the database"""
-        return self.service_klass.objects
+        return self.service_klass.query()
 
     def limit_query(self, query, **kwargs):
         """limit the results of a query to what want the user to see"""
@@ -44,7 +69,7 @@ class BaseResource(Resource):
         try:
             obj = self.service_klass.get(obj_id)
         except Exception as e:
-            print(e)
+            logger.debug("fetch of %s failed: %s", obj_id, e)
             return abort(404, {"desc": "requested object does not exist"})
         return obj
 
@@ -69,6 +94,113 @@ class BaseResource(Resource):
         """
         return self.service_klass.update(obj_id, **data)
 
+    @staticmethod
+    def make_etag(*parts):
+        """ build an opaque etag value out of the parts that identify a representation """
+        raw = "|".join(str(part) for part in parts)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get_validators(self, obj):
+        """
+        etag and last modified date of a single object, derived from its last_updated date
+
+        :param obj: the object about to be sent
+        :return: (etag, last_modified)
+        """
+        last_modified = getattr(obj, "last_updated", None)
+        if not last_modified:
+            return None, None
+        return self.make_etag(self.__class__.__name__, obj.pk, last_modified.isoformat()), last_modified
+
+    def get_list_validators(self, query):
+        """
+        etag and last modified date of a list, derived from the most recent last_updated date and the number of
+        objects in the list. Computed on the database so no document is loaded.
+
+        :param query: the limited query about to be sent
+        :return: (etag, last_modified)
+        """
+        result = list(query.aggregate({"$group": {"_id": None,
+                                                  "count": {"$sum": 1},
+                                                  "last_updated": {"$max": "$last_updated"}}}))
+        if not result:
+            return self.make_etag(self.__class__.__name__, 0), None
+        count = result[0].get("count")
+        last_modified = result[0].get("last_updated")
+        return self.make_etag(self.__class__.__name__, count, last_modified.isoformat() if last_modified else ""), \
+            last_modified
+
+    def cache_headers(self, etag=None, last_modified=None):
+        """ response headers that let clients and CDNs revalidate instead of downloading the body again """
+
+        headers = {"Cache-Control": self.cache_control}
+        if self.vary:
+            headers["Vary"] = ", ".join(self.vary)
+        if etag:
+            headers["ETag"] = quote_etag(etag, weak=True)
+        if last_modified:
+            headers["Last-Modified"] = http_date(last_modified.replace(tzinfo=timezone.utc))
+        return headers
+
+    def is_not_modified(self, etag=None, last_modified=None):
+        """
+        checks the conditional headers of the request. If-None-Match takes precedence over If-Modified-Since
+
+        :return: True if the client already holds the current representation
+        """
+        if request.if_none_match:
+            return bool(etag) and request.if_none_match.contains_weak(etag)
+
+        if last_modified and request.if_modified_since:
+            # http dates have no sub second precision
+            last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+            return last_modified <= request.if_modified_since
+        return False
+
+    def conditional_response(self, data, etag=None, last_modified=None):
+        """ returns 304 when the client copy is still fresh, otherwise data with the validators attached """
+
+        headers = self.cache_headers(etag=etag, last_modified=last_modified)
+        if self.is_not_modified(etag=etag, last_modified=last_modified):
+            response = make_response("", 304)
+            response.headers.extend(headers)
+            return response
+        return data(), 200, headers
+
+    def cache_key(self):
+        """ cache key of the current list request: resource, normalized query params, user, tenant and versions """
+
+        params = sorted((key, sorted(request.args.getlist(key))) for key in request.args.keys())
+        user_context = request.environ.get("user_context") or {}
+        models = self.cache_dependencies or [self.service_klass.model_class]
+        return cache.make_key(self.__class__.__name__, params, user_context.get("id"), tenant.get_instance_id(),
+                              models=models)
+
+    def list_response(self, query, schema):
+        """
+        serves a list, from the query result cache when the resource enables it
+
+        :param query: the limited query
+        :param schema: the response schema
+        """
+        key = self.cache_key() if self.cache_timeout else None
+        entry = cache.get_cache().get(key) if key else None
+        if entry:
+            last_modified = datetime.fromisoformat(entry["last_modified"]) if entry.get("last_modified") else None
+            return self.conditional_response(lambda: entry["body"], etag=entry["etag"], last_modified=last_modified)
+
+        etag, last_modified = self.get_list_validators(query)
+
+        def body():
+            data = {"data": schema().dump(query, many=True)}
+            if key:
+                cache.get_cache().set(key, {"body": data, "etag": etag,
+                                            "last_modified": last_modified.isoformat() if last_modified else None},
+                                      ttl=self.cache_timeout)
+            return data
+
+        return self.conditional_response(body, etag=etag, last_modified=last_modified)
+
     def get(self, obj_id=None):
         """
 
@@ -80,11 +212,13 @@ class BaseResource(Resource):
         if not obj_id:
             base_query = self.query()
             limited_query = self.limit_query(base_query)
-            return {"data": schema().dump(limited_query, many=True)}
+            return self.list_response(limited_query, schema)
         obj = self.fetch(obj_id)
         if not obj:
             abort(409, {"desc": "requested resource doesn't exist"})
-        return schema().dump(self.limit_get(obj))
+        obj = self.limit_get(obj)
+        etag, last_modified = self.get_validators(obj)
+        return self.conditional_response(lambda: schema().dump(obj), etag=etag, last_modified=last_modified)
 
     def post(self):
         """
@@ -92,6 +226,17 @@ class BaseResource(Resource):
         :return:
         :rtype:
         """
+        key = request.headers.get(idempotency.HEADER)
+        if key and self.idempotent:
+            return idempotency.run(key, self.create)
+        return self.create()
+
+    def create(self):
+        """
+        validates and saves the body of a post request
+
+        :return: the serialized object that was created
+        """
         serializer = self.serializers.get("default")
 
         try:
@@ -137,7 +282,7 @@ class BaseResource(Resource):
         """
 
         self.limit_get(self.fetch(obj_id))
-        self.service_klass.update(obj_id, deleted=True)
+        self.service_klass.soft_delete(obj_id)
         return {"status": "successful"}
 
     @classmethod
@@ -0,0 +1,135 @@
+# coding=utf-8
+"""
+revocation.py
+
+In-memory view of the revoked tokens, so AuthMiddleware checks revocation without a database round trip.
+
+Revocations are written to the RevokedToken collection and mirrored in each worker as a dict of revoked jti ->
+expiry plus a dict of user id -> date before which every token of the user is revoked. The worker pulls new
+revocations at most every REVOCATION_SYNC_INTERVAL_SECONDS, reading only those recorded since its previous sync
+(with an overlap for clock skew between writers), and forgets entries once the tokens they cover have expired.
+A revocation made on one worker is therefore effective on the others within one sync interval.
+"""
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+
+from pymongo.errors import PyMongoError, DuplicateKeyError
+
+import settings
+from ..models import RevokedToken
+
+logger = logging.getLogger(__name__)
+
+# revocations recorded by workers whose clocks run this much behind are still picked up
+SYNC_OVERLAP = timedelta(seconds=60)
+
+
+class RevocationList(object):
+    """ revoked token ids and users of a worker, synced incrementally from the RevokedToken collection """
+
+    def __init__(self, sync_interval=None):
+        self.sync_interval = settings.REVOCATION_SYNC_INTERVAL_SECONDS if sync_interval is None else sync_interval
+        self._tokens = {}
+        self._users = {}
+        self._synced_at = None
+        self._next_sync = 0
+        self._lock = threading.Lock()
+
+    def is_revoked(self, claims):
+        """
+        whether the token with these (already verified) claims was revoked
+
+        :param claims: decoded token payload
+        """
+        if time.monotonic() >= self._next_sync:
+            self.sync()
+        if claims.get("jti") in self._tokens:
+            return True
+        revoked_before = self._users.get(claims.get("id"))
+        if revoked_before is None:
+            return False
+        if claims.get("iat_ms") is not None:
+            return claims["iat_ms"] / 1000.0 < revoked_before
+        # iat has second granularity, tokens issued in the second of the revocation are given the benefit of the doubt
+        return claims.get("iat", 0) < int(revoked_before)
+
+    def sync(self):
+        """ pull the revocations recorded since the previous sync and drop the expired ones """
+        if not self._lock.acquire(blocking=False):
+            # another thread is syncing, the current state is recent enough
+            return
+        try:
+            now = datetime.utcnow()
+            query = {"expires_at": {"$gt": now}}
+            if self._synced_at:
+                query["revoked_at"] = {"$gte": self._synced_at - SYNC_OVERLAP}
+            for doc in RevokedToken._mongometa.collection.find(query, projection={"jti": 1, "user_id": 1,
+                                                                                   "revoked_at": 1,
+                                                                                   "expires_at": 1}):
+                self._add(doc.get("jti"), doc.get("user_id"), doc["revoked_at"], doc["expires_at"])
+
+            expired = _timestamp(now)
+            self._tokens = {jti: expires for jti, expires in self._tokens.items() if expires > expired}
+            self._users = {user_id: revoked for user_id, revoked in self._users.items()
+                           if revoked + settings.JWT_REFRESH_EXPIRES_IN_DAYS * 86400 > expired}
+            self._synced_at = now
+        except PyMongoError as e:
+            # keep serving with the revocations known so far rather than failing every request
+            logger.warning("revoked token sync failed: %s", e)
+        finally:
+            self._next_sync = time.monotonic() + self.sync_interval
+            self._lock.release()
+
+    def _add(self, jti, user_id, revoked_at, expires_at):
+        if jti:
+            self._tokens[jti] = _timestamp(expires_at)
+        if user_id:
+            self._users[user_id] = max(self._users.get(user_id, 0), _timestamp(revoked_at))
+
+    def revoke(self, jti, expires_at):
+        """
+        revoke a single token
+
+        :param jti: id of the token
+        :param expires_at: expiry of the token, as a datetime or the exp claim
+        :return: False if the token was already revoked
+        """
+        if not isinstance(expires_at, datetime):
+            expires_at = datetime.utcfromtimestamp(expires_at)
+        now = datetime.utcnow()
+        try:
+            RevokedToken._mongometa.collection.insert_one({"_cls": RevokedToken._mongometa.object_name, "jti": jti,
+                                                           "revoked_at": now, "expires_at": expires_at})
+            revoked = True
+        except DuplicateKeyError:
+            revoked = False
+        self._add(jti, None, now, expires_at)
+        return revoked
+
+    def revoke_user(self, user_id):
+        """ revoke every token issued to a user so far, e.g. to log out everywhere or ban the user """
+        now = datetime.utcnow()
+        # access tokens expire sooner, this covers the refresh tokens
+        expires_at = now + timedelta(days=settings.JWT_REFRESH_EXPIRES_IN_DAYS)
+        RevokedToken._mongometa.collection.insert_one({"_cls": RevokedToken._mongometa.object_name,
+                                                       "user_id": str(user_id), "revoked_at": now,
+                                                       "expires_at": expires_at})
+        self._add(None, str(user_id), now, expires_at)
+
+
+def _timestamp(date):
+    """ posix timestamp of a naive utc datetime, comparable to the iat and exp claims """
+    return (date - datetime(1970, 1, 1)).total_seconds()
+
+
+_revocations = None
+
+
+def get_revocations():
+    """ the revocation list of the current worker, created on first use """
+    global _revocations
+    if _revocations is None:
+        _revocations = RevocationList()
+    return _revocations
@@ -13,14 +13,21 @@ overridden. Functionality for each service class include:
     - get: Retrieve an object by ID
     - get_by_ids: get an array of objects by a list of ids
     - query: Retrieve a collection of objects by query
+    - soft_delete: Flag an object as deleted, it is then excluded from get, find_one and query
     - delete: Delete an object by ID
     - delete_by_ids: Delete a collection of objects by query via ids
 
+Models carrying an instance_id are tenant scoped: lookups and writes are restricted to the tenant of the current
+request or job (see tenant.py).
+
 """
 
 from datetime import datetime
-from ..base import utils
+from ..base import utils, cache, tenant, migrations
 from bson.objectid import ObjectId
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class ServiceFactory(object):
@@ -35,6 +42,32 @@ class ServiceFactory(object):
         class BaseService:
             model_class = klass
             objects = klass.objects
+            # models declaring a "deleted" field are soft deleted, deleted objects are hidden from every lookup
+            soft_deletes = klass._mongometa.get_field("deleted") is not None
+            # models declaring an "instance_id" field are scoped to the current tenant, it is also their shard key
+            tenant_scoped = klass._mongometa.get_field("instance_id") is not None
+
+            @classmethod
+            def live_filter(cls, include_deleted=False):
+                """ filter matching objects that are not soft deleted """
+                # equality rather than $ne so the partial indexes on {"deleted": False} can serve the query
+                if not cls.soft_deletes or include_deleted:
+                    return {}
+                return {"deleted": False}
+
+            @classmethod
+            def scoped(cls, params=None, include_deleted=False):
+                """ params restricted to live objects of the current tenant """
+
+                # the live filter misses documents written before soft delete until they are backfilled
+                migrations.apply()
+                params = dict(cls.live_filter(include_deleted), **(params or {}))
+                if cls.tenant_scoped:
+                    instance_id = tenant.get_instance_id()
+                    if instance_id and "instance_id" not in params:
+                        params["instance_id"] = instance_id
+                    tenant.check_scoped(cls.model_class, params)
+                return params
 
             @classmethod
             def _prepare_id(cls, obj_id):
@@ -45,7 +78,7 @@ class ServiceFactory(object):
                 return obj_id
 
             @classmethod
-            def get(cls, obj_id):
+            def get(cls, obj_id, include_deleted=False):
                 """ Get a single object from the database collection """
 
                 if isinstance(obj_id, cls.model_class):
@@ -53,23 +86,40 @@ class ServiceFactory(object):
 
                 _obj_id = obj_id
                 obj_id = cls._prepare_id(obj_id)
-                obj = cls.model_class.objects.get({"_id": obj_id})
+                obj = cls.model_class.objects.get(cls.scoped({"_id": obj_id}, include_deleted))
                 return obj
 
             @classmethod
-            def find_one(cls, params):
+            def query(cls, params=None, include_deleted=False):
+                """ Retrieve a collection of objects matching params """
+
+                return cls.model_class.objects.raw(cls.scoped(params, include_deleted))
+
+            @classmethod
+            def find_one(cls, params, include_deleted=False):
                 """ Find a single object that matches the criteria within the parameters """
 
                 try:
-                    obj = cls.model_class.objects.get(params)
+                    obj = cls.model_class.objects.get(cls.scoped(params, include_deleted))
                     return obj
                 except klass.DoesNotExist:
-                    print("Could not find any object that matches this criteria")
+                    logger.debug("no %s matches %s", klass.__name__, params)
                     return
                 except Exception as e:
-                    print(e)
+                    logger.warning("%s lookup failed: %s", klass.__name__, e)
                     raise
 
+            @classmethod
+            def _save(cls, obj):
+                """ Save obj. Replacements on tenant scoped models carry the shard key so they target a single shard """
+
+                if not cls.tenant_scoped or cls.model_class._mongometa.pk.is_undefined(obj):
+                    return obj.save()
+                obj.full_clean()
+                cls.model_class._mongometa.collection.replace_one({"_id": obj.pk, "instance_id": obj.instance_id},
+                                                                  obj.to_son())
+                return obj
+
             @classmethod
             def create(cls, ignored_args=None, **kwargs):
                 """ base create method."""
@@ -79,14 +129,17 @@ class ServiceFactory(object):
 
                 obj = cls.model_class()
                 data = utils.clean_kwargs(ignored_args, kwargs)
+                if cls.tenant_scoped and not data.get("instance_id"):
+                    data["instance_id"] = tenant.get_instance_id()
                 obj = utils.populate_obj(obj, data)
 
                 try:
                     # print("===========>>>>did it save==========>>", obj)
                     obj = obj.save()
+                    cache.invalidate(cls.model_class)
                     return obj
                 except Exception as e:
-                    print(e)
+                    logger.warning("%s create failed: %s", klass.__name__, e)
                     raise
 
             @classmethod
@@ -98,27 +151,40 @@ class ServiceFactory(object):
 
                 obj = cls.get(obj_id)
                 data = utils.clean_kwargs(ignored_args, kwargs)
+                if cls.tenant_scoped:
+                    # objects never move between tenants
+                    data.pop("instance_id", None)
                 obj = utils.populate_obj(obj, data)
                 if "last_updated" in ignored_args:
                     obj.last_updated = datetime.utcnow()
                 try:
-                    obj = obj.save()
+                    obj = cls._save(obj)
+                    cache.invalidate(cls.model_class)
                     return obj
                 except Exception as e:
-                    print(e)
+                    logger.warning("%s update of %s failed: %s", klass.__name__, obj.pk, e)
                     raise
 
+            @classmethod
+            def soft_delete(cls, obj_id):
+                """ Flag an object as deleted. It stays in the collection until archived (see src/jobs/archival.py) """
+
+                if not cls.soft_deletes:
+                    raise ValueError("{} does not support soft delete".format(cls.model_class.__name__))
+                return cls.update(obj_id, deleted=True, deleted_at=datetime.utcnow())
+
             @classmethod
             def delete(cls, obj_id):
                 """ Delete object by id """
 
-                obj = cls.get(obj_id)
+                obj = cls.get(obj_id, include_deleted=True)
 
                 try:
                     obj.delete()
+                    cache.invalidate(cls.model_class)
                     return obj
                 except Exception as e:
-                    print(e)
+                    logger.warning("%s delete of %s failed: %s", klass.__name__, obj.pk, e)
                     raise
 
         return BaseService
@@ -0,0 +1,78 @@
+# coding=utf-8
+"""
+tenant.py
+
+The tenant (instance_id) of the current unit of work.
+
+Inside a request the tenant is resolved once by AuthMiddleware and read from the WSGI environ; jobs and scripts set
+it explicitly with tenant_scope. BaseService adds it to every query and write on models that carry an instance_id,
+which is also the shard key of those collections. Queries on tenant scoped models that reach the database without an
+instance_id would be broadcast to every shard; check_scoped flags them according to TENANT_QUERY_GUARD.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+
+from flask import has_request_context, request
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+_instance_id = ContextVar("instance_id", default=None)
+_any_tenant = ContextVar("any_tenant", default=False)
+
+
+class ScatterGatherQuery(Exception):
+    """ raised for a query on a tenant scoped model without instance_id when TENANT_QUERY_GUARD is "raise" """
+
+
+def get_instance_id():
+    """ the tenant of the current job or request, None when unknown """
+    instance_id = _instance_id.get()
+    if instance_id is None and has_request_context():
+        instance_id = request.environ.get("instance_id")
+    return instance_id
+
+
+@contextmanager
+def tenant_scope(instance_id):
+    """
+    run a block of code for a tenant, e.g. inside a job
+
+        with tenant_scope("instance-1"):
+            ProductService.query()
+    """
+    token = _instance_id.set(instance_id)
+    try:
+        yield instance_id
+    finally:
+        _instance_id.reset(token)
+
+
+@contextmanager
+def any_tenant():
+    """
+    run a block of code whose queries deliberately span tenants, e.g. finding the user logging in by email when the
+    tenant is not known yet. check_scoped lets them through.
+    """
+    token = _any_tenant.set(True)
+    try:
+        yield
+    finally:
+        _any_tenant.reset(token)
+
+
+def check_scoped(model_class, params):
+    """
+    flag a query on a tenant scoped model that does not target a single tenant
+
+    :param model_class: the queried model
+    :param params: the query filter
+    """
+    if "instance_id" in params or settings.TENANT_QUERY_GUARD == "off" or _any_tenant.get():
+        return
+    message = "scatter-gather query on {}: {}".format(model_class.__name__, sorted(params))
+    if settings.TENANT_QUERY_GUARD == "raise":
+        raise ScatterGatherQuery(message)
+    logger.warning(message)
@@ -12,6 +12,7 @@ without the application context.
 """
 from datetime import date, datetime
 from math import ceil
+import logging
 
 from bson.objectid import ObjectId
 import json
@@ -20,6 +21,8 @@ from pymodm import MongoModel, EmbeddedMongoModel
 from pymodm.queryset import QuerySet
 import settings
 
+logger = logging.getLogger(__name__)
+
 
 class CustomJSONEncoder(json.JSONEncoder):
     """ JSON encoder that supports date formats """
@@ -61,7 +64,7 @@ def marshal(resp, schema):
         try:
             resp_ = schema().load(data=data, unknown=EXCLUDE)
         except ValidationError as e:
-            print("Errors", e)
+            logger.debug("marshal failed: %s", e.messages)
             raise ValidationFailed(data=e.messages)
     return resp_
 
@@ -121,5 +124,6 @@ def add_resource(resource, *args):
 
     """
     from src import api
-    print(*[f"{settings.API_PREFIX if settings.API_PREFIX else ''}{arg}" for arg in args])
-    api.add_resource(resource, *[f"{settings.API_PREFIX if settings.API_PREFIX else ''}{arg}" for arg in args])
+    urls = [f"{settings.API_PREFIX if settings.API_PREFIX else ''}{arg}" for arg in args]
+    logger.debug("routing %s to %s", " ".join(urls), resource.__name__)
+    api.add_resource(resource, *urls)
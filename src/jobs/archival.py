@@ -0,0 +1,89 @@
+# coding=utf-8
+"""
+archival.py
+
+Archival of soft deleted documents.
+
+Soft deleted documents stay in their collection, hidden by BaseService, until they have been deleted for a while.
+archive moves them in batches to a <collection>_archive collection so the live collections and their indexes only
+hold documents that can still be served.
+"""
+from datetime import datetime, timedelta
+
+from pymongo.errors import BulkWriteError
+
+from ..base import cache
+from ..models import User, Category, SubCategory, Location, Product
+
+# models with a deleted field
+SOFT_DELETE_MODELS = [User, Category, SubCategory, Location, Product]
+
+DUPLICATE_KEY = 11000
+
+
+def _models(names=None):
+    if not names:
+        return SOFT_DELETE_MODELS
+    return [model for model in SOFT_DELETE_MODELS if model._mongometa.collection_name in names]
+
+
+def archive(older_than_days=30, batch_size=500, collections=None, progress=None):
+    """
+    move documents soft deleted more than older_than_days ago to their archive collection
+
+    :param older_than_days: grace period during which a deleted document can still be restored in place
+    :param batch_size: documents moved at a time
+    :param collections: only archive these collections
+    :param progress: called with the running stats after every batch
+    :return: number of documents archived per collection
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    stats = {}
+
+    for model in _models(collections):
+        collection = model._mongometa.collection
+        archived = collection.database["{}_archive".format(collection.name)]
+        query = {"deleted": True, "deleted_at": {"$lt": cutoff}}
+        stats[collection.name] = 0
+
+        while True:
+            docs = list(collection.find(query, sort=[("deleted_at", 1)], limit=batch_size))
+            if not docs:
+                break
+
+            now = datetime.utcnow()
+            for doc in docs:
+                doc["archived_at"] = now
+            try:
+                archived.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # documents copied by an earlier, interrupted run are already there
+                if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                    raise
+
+            result = collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}, "deleted": True})
+            stats[collection.name] += result.deleted_count
+            if progress:
+                progress(dict(stats))
+
+        if stats[collection.name]:
+            cache.invalidate(model)
+    return stats
+
+
+def backfill(collections=None, progress=None):
+    """
+    set deleted=False on documents written before soft delete existed, so the live filter and the partial indexes
+    on {"deleted": False} see them
+
+    :return: number of documents updated per collection
+    """
+    stats = {}
+    for model in _models(collections):
+        collection = model._mongometa.collection
+        result = collection.update_many({"deleted": {"$exists": False}}, {"$set": {"deleted": False}})
+        stats[collection.name] = result.modified_count
+        cache.invalidate(model)
+        if progress:
+            progress(dict(stats))
+    return stats
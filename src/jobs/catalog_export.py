@@ -0,0 +1,190 @@
+# coding=utf-8
+"""
+catalog_export.py
+
+Streaming product catalog export to NDJSON or CSV.
+
+Products are walked with a server side cursor sorted by _id. Categories and sub categories referenced by a batch are
+dereferenced with one $in query per batch (and remembered, there are few of them), currencies are loaded once.
+Output is produced batch by batch, optionally gzip compressed, so memory stays flat whatever the catalog size. Since
+the walk is in _id order, an interrupted export resumes from the last _id written.
+"""
+from itertools import islice
+import csv
+import gzip
+import io
+import json
+import os
+import zlib
+
+from bson.objectid import ObjectId
+
+from ..base.utils import CustomJSONEncoder
+from ..models import Category, SubCategory, Currency, Product
+
+
+CSV_COLUMNS = ["_id", "name", "sku", "code", "description", "category_code", "category_name", "sub_category_code",
+               "sub_category_name", "price", "cost_price", "currency", "currency_symbol", "quantity",
+               "unlimited_stock", "tags", "images", "visible", "date_created", "last_updated"]
+
+
+class CatalogExport(object):
+    """
+    Exports products matching a query.
+
+        CatalogExport(fmt="csv").to_file("catalog.csv.gz")
+    """
+
+    content_types = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+    def __init__(self, fmt="ndjson", query=None, batch_size=1000):
+        """
+
+        :param fmt: "ndjson" or "csv"
+        :param query: raw filter on products, soft deleted products are never exported
+        :param batch_size: products fetched and written at a time
+        """
+        if fmt not in self.content_types:
+            raise ValueError("unsupported export format {}".format(fmt))
+        self.fmt = fmt
+        self.query = dict(query or {}, deleted=False)
+        self.batch_size = batch_size
+        self._categories = {}
+        self._sub_categories = {}
+        self._currencies = None
+
+    def _load_references(self, docs):
+        """ fetch the categories and sub categories of a batch that are not known yet, one query each """
+
+        for model, known, name in ((Category, self._categories, "category"),
+                                   (SubCategory, self._sub_categories, "sub_category")):
+            missing = {doc[name] for doc in docs if doc.get(name) and doc[name] not in known}
+            if missing:
+                for ref in model._mongometa.collection.find({"_id": {"$in": list(missing)}},
+                                                            projection={"code": 1, "name": 1}):
+                    known[ref["_id"]] = {"id": str(ref["_id"]), "code": ref.get("code"), "name": ref.get("name")}
+
+        if self._currencies is None:
+            self._currencies = {ref["_id"]: {"code": ref["_id"], "name": ref.get("name"), "symbol": ref.get("symbol")}
+                                for ref in Currency._mongometa.collection.find({})}
+
+    def batches(self, after_id=None):
+        """
+        yields lists of export records in _id order
+
+        :param after_id: resume after this product id
+        """
+        query = self.query
+        if after_id:
+            query = {"$and": [query, {"_id": {"$gt": ObjectId(str(after_id))}}]}
+
+        cursor = Product._mongometa.collection.find(query, sort=[("_id", 1)], batch_size=self.batch_size)
+        try:
+            while True:
+                docs = list(islice(cursor, self.batch_size))
+                if not docs:
+                    return
+                self._load_references(docs)
+                yield [self.record(doc) for doc in docs]
+        finally:
+            cursor.close()
+
+    def record(self, doc):
+        """ a raw product document with its references resolved """
+
+        doc.pop("_cls", None)
+        doc["category"] = self._categories.get(doc.get("category"))
+        doc["sub_category"] = self._sub_categories.get(doc.get("sub_category"))
+        prices = [doc[key] for key in ("price", "discount_price") if doc.get(key)]
+        prices += [price for variant in doc.get("variants") or [] for price in variant.get("prices") or []]
+        for price in prices:
+            price["currency"] = self._currencies.get(price.get("currency")) or {"code": price.get("currency")}
+        return doc
+
+    def _csv_row(self, record):
+        category = record.get("category") or {}
+        sub_category = record.get("sub_category") or {}
+        price = record.get("price") or {}
+        currency = price.get("currency") or {}
+        return {"_id": record["_id"], "name": record.get("name"), "sku": record.get("sku"),
+                "code": record.get("code"), "description": record.get("description"),
+                "category_code": category.get("code"), "category_name": category.get("name"),
+                "sub_category_code": sub_category.get("code"), "sub_category_name": sub_category.get("name"),
+                "price": price.get("value"), "cost_price": price.get("cost_value"),
+                "currency": currency.get("code"), "currency_symbol": currency.get("symbol"),
+                "quantity": record.get("quantity"), "unlimited_stock": record.get("unlimited_stock"),
+                "tags": "|".join(record.get("tags") or []), "images": "|".join(record.get("images") or []),
+                "visible": record.get("visible"), "date_created": record.get("date_created"),
+                "last_updated": record.get("last_updated")}
+
+    def encode(self, records, header=False):
+        """ encode a batch of records in the export format """
+
+        if self.fmt == "ndjson":
+            return "".join(json.dumps(record, cls=CustomJSONEncoder) + "\n" for record in records).encode("utf-8")
+
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS)
+        if header:
+            writer.writeheader()
+        writer.writerows(self._csv_row(record) for record in records)
+        return buffer.getvalue().encode("utf-8")
+
+    def chunks(self, after_id=None, compress=False):
+        """
+        yields the export as bytes, one chunk per batch. Suitable for a streamed response.
+
+        :param after_id: resume after this product id, the csv header is only written on a fresh export
+        :param compress: gzip the output, flushed after every batch so the client receives each batch as it is
+            read rather than whenever the compressor fills its buffer
+        """
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+        header = self.fmt == "csv" and not after_id
+        for records in self.batches(after_id=after_id):
+            data = self.encode(records, header=header)
+            header = False
+            yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+        if compressor:
+            yield compressor.flush()
+
+    def to_file(self, path, compress=None, resume=True, progress=None):
+        """
+        export to a file. The last _id and file size written are kept in <path>.checkpoint after every batch, so a
+        rerun with resume=True continues from where an interrupted export stopped.
+
+        :param path: output file
+        :param compress: gzip the output, defaults to True when path ends with .gz
+        :param resume: continue an interrupted export of the same path
+        :param progress: called with the running stats after every batch
+        :return: dict with the number of products written and the last _id
+        """
+        compress = path.endswith(".gz") if compress is None else compress
+        checkpoint = path + ".checkpoint"
+        after_id, size = None, 0
+        if resume and os.path.exists(checkpoint) and os.path.exists(path):
+            with io.open(checkpoint) as fp:
+                after_id, size = fp.read().split()
+            size = int(size)
+
+        written = 0
+        with io.open(path, "r+b" if after_id else "wb") as fp:
+            # drop anything written after the last checkpoint, it is exported again
+            fp.seek(size)
+            fp.truncate()
+            header = self.fmt == "csv" and not after_id
+            for records in self.batches(after_id=after_id):
+                data = self.encode(records, header=header)
+                header = False
+                # every batch is its own gzip member, so the file is valid up to any checkpoint
+                fp.write(gzip.compress(data) if compress else data)
+                fp.flush()
+                after_id = records[-1]["_id"]
+                written += len(records)
+                with io.open(checkpoint, "w") as cp:
+                    cp.write("{} {}".format(after_id, fp.tell()))
+                if progress:
+                    progress({"products": written, "last_id": str(after_id)})
+
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return {"products": written, "last_id": str(after_id) if after_id else None}
@@ -0,0 +1,294 @@
+# coding=utf-8
+"""
+catalog_import.py
+
+Streaming product catalog import.
+
+Rows are read lazily from a CSV or NDJSON file, validated and normalized with ProductImportSchema in a process pool,
+resolved against a lookup table of categories, sub categories and currencies loaded once per import, and written in
+unordered bulk_write batches that upsert products by (instance_id, user, sku). Memory stays bounded by the batch size and the
+number of chunks in flight. Rows that fail are written to a per-row error report as they occur instead of aborting the
+import; only the first max_errors of them are also kept in memory.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+import csv
+import gzip
+import io
+import json
+import time
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ..base import cache
+from ..models import Category, SubCategory, Currency, Product, FxRate, normalized_prices
+
+
+def open_rows(path, fmt=None):
+    """
+    yields (row number, row dict) from a csv or ndjson file, optionally gzip compressed
+
+    :param path: path of the file
+    :param fmt: "csv" or "ndjson", guessed from the file name when not given
+    """
+    name = path[:-3] if path.endswith(".gz") else path
+    fmt = fmt or ("csv" if name.endswith(".csv") else "ndjson")
+    opener = gzip.open if path.endswith(".gz") else io.open
+
+    with opener(path, "rt", encoding="utf-8", newline="") as fp:
+        if fmt == "csv":
+            for number, row in enumerate(csv.DictReader(fp), start=2):
+                yield number, row
+            return
+
+        for number, line in enumerate(fp, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, {"__error__": str(e)}
+
+
+def validate_rows(rows):
+    """
+    validate a chunk of rows with ProductImportSchema. Runs in the worker processes.
+
+    :param rows: list of (row number, row dict)
+    :return: list of (row number, data, errors)
+    """
+    from ..schemas import ProductImportSchema
+    from marshmallow import ValidationError
+
+    schema = ProductImportSchema()
+    results = []
+    for number, row in rows:
+        if "__error__" in row:
+            results.append((number, None, {"_row": [row["__error__"]]}))
+            continue
+        try:
+            results.append((number, schema.load(row), None))
+        except ValidationError as e:
+            results.append((number, None, e.messages))
+    return results
+
+
+class LookupTable(object):
+    """ category, sub category and currency codes of an instance, loaded once per import """
+
+    def __init__(self, instance_id):
+        self.categories = {doc["code"]: doc["_id"] for doc in Category._mongometa.collection.find(
+            {"instance_id": instance_id, "deleted": False}, projection={"code": 1})}
+        self.category_ids = set(self.categories.values())
+        self.sub_categories = {}
+        # sub category id -> id of its category
+        self.parents = {}
+        for doc in SubCategory._mongometa.collection.find({"instance_id": instance_id, "deleted": False},
+                                                           projection={"code": 1, "category": 1}):
+            self.sub_categories[(doc["category"], doc["code"])] = doc["_id"]
+            self.parents[doc["_id"]] = doc["category"]
+        self.currencies = set(Currency._mongometa.collection.distinct("_id"))
+        self.rates = FxRate.table(fresh=True)
+
+    def resolve(self, data):
+        """
+        replace codes in a validated row with ids
+
+        :return: (document, errors)
+        """
+        errors = {}
+        category_code = data.pop("category_code", None)
+        sub_category_code = data.pop("sub_category_code", None)
+
+        if category_code:
+            data["category"] = self.categories.get(category_code)
+            if not data["category"]:
+                errors["category_code"] = ["Unknown category {}".format(category_code)]
+        elif data.get("category"):
+            data["category"] = self._object_id(data, "category", errors)
+            if data["category"] and data["category"] not in self.category_ids:
+                errors["category"] = ["Unknown category {}".format(data["category"])]
+
+        if sub_category_code:
+            data["sub_category"] = self.sub_categories.get((data.get("category"), sub_category_code))
+            if not data["sub_category"]:
+                errors["sub_category_code"] = ["Unknown sub category {}".format(sub_category_code)]
+        elif data.get("sub_category"):
+            data["sub_category"] = self._object_id(data, "sub_category", errors)
+            if data["sub_category"] and self.parents.get(data["sub_category"]) != data.get("category"):
+                errors["sub_category"] = ["Unknown sub category {} for this category".format(data["sub_category"])]
+
+        if data.get("location"):
+            data["location"] = self._object_id(data, "location", errors)
+
+        prices = [data[key] for key in ("price", "discount_price") if data.get(key)]
+        prices += [price for variant in data.get("variants") or [] for price in variant.get("prices") or []]
+        for price in prices:
+            if price.get("currency") not in self.currencies:
+                errors.setdefault("currency", []).append("Unknown currency {}".format(price.get("currency")))
+
+        return data, errors
+
+    @staticmethod
+    def _object_id(data, name, errors):
+        """ the id in data[name] as an ObjectId, None with an error when it is not a valid id """
+        if ObjectId.is_valid(str(data[name])):
+            return ObjectId(str(data[name]))
+        errors[name] = ["Invalid {} id {}".format(name.replace("_", " "), data[name])]
+        return None
+
+
+def _in_order(executor, chunks, max_in_flight):
+    """ like executor.map, but only keeps max_in_flight chunks submitted so the input is consumed lazily """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(validate_rows, chunk))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class CatalogImport(object):
+    """
+    Imports products for a seller.
+
+        stats = CatalogImport(user_id, instance_id).run(open_rows("catalog.csv"))
+    """
+
+    def __init__(self, user_id, instance_id, batch_size=1000, workers=None, chunk_size=200, progress=None,
+                 report=None, max_errors=100):
+        """
+
+        :param user_id: the seller owning the imported products
+        :param instance_id: the instance whose categories are used
+        :param batch_size: products per bulk_write
+        :param workers: validation processes, defaults to the number of cpus
+        :param chunk_size: rows sent to a worker at a time
+        :param progress: called with the running stats after every batch
+        :param report: path of the ndjson file every row error is written to
+        :param max_errors: row errors kept in errors, the report has all of them
+        """
+        self.user = ObjectId(str(user_id))
+        self.instance_id = instance_id
+        self.batch_size = batch_size
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.report = report
+        self.max_errors = max_errors
+        self.errors = []
+        self._report_fp = None
+        self.stats = {"rows": 0, "valid": 0, "invalid": 0, "upserted": 0, "modified": 0, "batches": 0}
+
+    def _error(self, number, sku, errors):
+        error = {"row": number, "sku": sku, "errors": errors}
+        if len(self.errors) < self.max_errors:
+            self.errors.append(error)
+        if self._report_fp:
+            self._report_fp.write(json.dumps(error, default=str) + "\n")
+        self.stats["invalid"] += 1
+
+    def _operation(self, data, now, rates):
+        # importing the sku of a soft deleted product brings it back
+        document = dict(data, user=self.user, instance_id=self.instance_id, last_updated=now, deleted=False)
+        values = normalized_prices(data, rates)
+        document["normalized_price"] = values["normalized_price"]
+        if data.get("variants"):
+            document["variants"] = [dict(variant, normalized_price=values["variants.{}.normalized_price".format(i)])
+                                    for i, variant in enumerate(data["variants"])]
+        document.setdefault("quantity", 1)
+        return UpdateOne({"instance_id": self.instance_id, "user": self.user, "sku": data["sku"]},
+                         {"$set": document,
+                          "$setOnInsert": {"date_created": now, "_cls": Product._mongometa.object_name},
+                          "$unset": {"deleted_at": ""}},
+                         upsert=True)
+
+    def _write(self, batch):
+        """ batch is a list of (row number, sku, operation) """
+        if not batch:
+            return
+        try:
+            result = Product._mongometa.collection.bulk_write([operation for _, _, operation in batch],
+                                                              ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for error in details.get("writeErrors", []):
+                number, sku, _ = batch[error["index"]]
+                self._error(number, sku, {"_write": [error.get("errmsg")]})
+
+        failed = len(details.get("writeErrors", []))
+        self.stats["valid"] += len(batch) - failed
+        self.stats["upserted"] += details.get("nUpserted", 0)
+        self.stats["modified"] += details.get("nModified", 0)
+        self.stats["batches"] += 1
+
+    def _report_progress(self, started):
+        elapsed = time.monotonic() - started
+        self.stats["seconds"] = round(elapsed, 3)
+        self.stats["rows_per_second"] = round(self.stats["rows"] / elapsed, 1) if elapsed else None
+        if self.progress:
+            self.progress(dict(self.stats))
+
+    def run(self, rows):
+        """
+        import rows, as yielded by open_rows
+
+        :return: stats dict
+        """
+        lookup = LookupTable(self.instance_id)
+        started = time.monotonic()
+
+        if self.report:
+            self._report_fp = io.open(self.report, "w", encoding="utf-8")
+        try:
+            self._import(rows, lookup, started)
+        finally:
+            if self._report_fp:
+                self._report_fp.close()
+                self._report_fp = None
+
+        self._report_progress(started)
+        if self.stats["valid"]:
+            cache.invalidate(Product)
+        return self.stats
+
+    def _import(self, rows, lookup, started):
+        batch = []
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            max_in_flight = (executor._max_workers or 1) * 2
+            for results in _in_order(executor, _chunks(rows, self.chunk_size), max_in_flight):
+                now = datetime.utcnow()
+                for number, data, errors in results:
+                    self.stats["rows"] += 1
+                    if errors:
+                        self._error(number, None, errors)
+                        continue
+
+                    data, errors = lookup.resolve(data)
+                    if errors:
+                        self._error(number, data.get("sku"), errors)
+                        continue
+                    batch.append((number, data["sku"], self._operation(data, now, lookup.rates)))
+
+                    if len(batch) >= self.batch_size:
+                        self._write(batch)
+                        batch = []
+                        self._report_progress(started)
+
+        self._write(batch)
@@ -0,0 +1,78 @@
+# coding=utf-8
+"""
+normalization.py
+
+Batch recompute of the normalized (base currency) prices of products.
+
+Run when exchange rates change: products are streamed in _id order with a projection limited to their prices and
+current normalized prices, recomputed against the rate table, and only the products whose normalized prices moved
+are written back, with one unordered bulk_write per batch.
+"""
+from datetime import datetime
+from itertools import islice
+import time
+
+from pymongo import UpdateOne
+
+from ..base import cache
+from ..models import Product, FxRate, normalized_prices
+
+PROJECTION = {"price.value": 1, "price.currency": 1, "normalized_price": 1, "variants.prices.value": 1,
+              "variants.prices.currency": 1, "variants.default_currency": 1, "variants.normalized_price": 1}
+
+
+def _current(doc):
+    """ the normalized prices stored on a product document, in the shape of normalized_prices """
+    values = {"variants.{}.normalized_price".format(i): variant.get("normalized_price")
+              for i, variant in enumerate(doc.get("variants") or [])}
+    values["normalized_price"] = doc.get("normalized_price")
+    return values
+
+
+def normalize_prices(currency=None, query=None, batch_size=1000, progress=None):
+    """
+    recompute the normalized prices of every product matching query
+
+    :param currency: only products priced in this currency code, i.e. the currency whose rate changed
+    :param query: raw filter on products, soft deleted products are skipped
+    :param batch_size: products per batch and per bulk_write
+    :param progress: called with the running stats after every batch
+    :return: stats dict
+    """
+    query = dict(query or {}, deleted=False)
+    if currency:
+        query["$or"] = [{"price.currency": currency}, {"variants.prices.currency": currency}]
+
+    # the rate may have just been set by another process, whose cache invalidation did not reach this one
+    rates = FxRate.table(fresh=True)
+    collection = Product._mongometa.collection
+    cursor = collection.find(query, projection=PROJECTION, sort=[("_id", 1)], batch_size=batch_size)
+
+    stats = {"products": 0, "updated": 0, "batches": 0}
+    started = time.monotonic()
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            break
+
+        now = datetime.utcnow()
+        operations = []
+        for doc in batch:
+            values = normalized_prices(doc, rates)
+            if values != _current(doc):
+                operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": dict(values, last_updated=now)}))
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+
+        stats["products"] += len(batch)
+        stats["updated"] += len(operations)
+        stats["batches"] += 1
+        elapsed = time.monotonic() - started
+        stats["seconds"] = round(elapsed, 3)
+        stats["products_per_second"] = round(stats["products"] / elapsed, 1) if elapsed else None
+        if progress:
+            progress(dict(stats))
+
+    if stats["updated"]:
+        cache.invalidate(Product)
+    return stats
@@ -0,0 +1,190 @@
+# coding=utf-8
+"""
+repricing.py
+
+Bulk repricing of products and their variants.
+
+Products are streamed from the database in _id order with a projection limited to their prices. Every price of a
+batch is laid out in NumPy arrays, the new selling, discount, mrsp and final values are computed for the whole batch
+at once, and the changed fields, along with the normalized prices they imply, are written back with one unordered
+bulk_write per batch.
+"""
+from datetime import datetime
+from itertools import islice
+import time
+
+import numpy as np
+from pymongo import UpdateOne
+
+from ..base import cache, tenant
+from ..models import Product, FxRate, normalized_prices
+from ..services.product import ProductService
+
+
+def round_up(values, decimals=2):
+    """ vectorized utils.roundUp. Values are rounded first so float noise (e.g. 1.1 * 100) does not add a cent """
+    factor = 10 ** decimals
+    return np.ceil(np.round(values * factor, 6)) / factor
+
+
+def _as_array(prices, name):
+    return np.array([price.get(name) if price.get(name) is not None else np.nan for price in prices], dtype=float)
+
+
+def compute_prices(prices, margin=None, discount=None, fx_rate=None):
+    """
+    compute new price fields for a list of raw price documents
+
+    Costs are always converted from the recorded source_cost_value and source_mrsp_value (the cost_value and
+    mrsp_value of prices repriced for the first time), which are kept as they are, so running the same repricing
+    again gives the same prices.
+
+    :param prices: price sub documents as stored on products
+    :param margin: profit margin applied to the cost, e.g. 0.25. Defaults to each price's own profit_margin
+    :param discount: discount applied to the selling value, e.g. 0.1. Defaults to each price's current discount ratio
+    :param fx_rate: multiplier from the currency the costs are recorded in to the price currency. Defaults to each
+        price's own fx_rate, or 1
+    :return: (mask, fields) mask marks the prices that could be repriced: those with a cost and a margin. fields
+        maps field names to arrays
+    """
+    source_cost = _as_array(prices, "source_cost_value")
+    # the mrsp_value of a repriced price may be derived from its selling value, it is not a recorded mrsp
+    repriced = ~np.isnan(source_cost)
+    source_cost = np.where(repriced, source_cost, _as_array(prices, "cost_value"))
+    source_mrsp = np.where(repriced, _as_array(prices, "source_mrsp_value"), _as_array(prices, "mrsp_value"))
+
+    if fx_rate is None:
+        rates = np.nan_to_num(_as_array(prices, "fx_rate"), nan=1.0)
+    else:
+        rates = np.full(len(prices), float(fx_rate))
+    cost = source_cost * rates
+    mrsp = source_mrsp * rates
+
+    if margin is None:
+        margins = _as_array(prices, "profit_margin")
+    else:
+        margins = np.full(len(prices), float(margin))
+
+    if discount is None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            discounts = np.nan_to_num(_as_array(prices, "discount_value") / _as_array(prices, "selling_value"),
+                                      nan=0.0, posinf=0.0, neginf=0.0)
+    else:
+        discounts = np.full(len(prices), float(discount))
+
+    selling = round_up(cost * (1 + margins))
+    discount_value = round_up(selling * discounts)
+    fields = {
+        "source_cost_value": source_cost,
+        "source_mrsp_value": source_mrsp,
+        "fx_rate": rates,
+        "cost_value": round_up(cost),
+        "selling_value": selling,
+        "discount_value": discount_value,
+        "value": np.maximum(selling - discount_value, 0),
+        "mrsp_value": np.where(np.isnan(mrsp), selling, np.maximum(round_up(mrsp), selling)),
+        "profit_margin": margins,
+    }
+    return ~np.isnan(cost) & ~np.isnan(margins), fields
+
+
+def _price_paths(doc):
+    """ yields (path, price) for every price of a product that should be repriced """
+
+    if doc.get("price"):
+        yield "price", doc["price"]
+    for i, variant in enumerate(doc.get("variants") or []):
+        for j, price in enumerate(variant.get("prices") or []):
+            yield "variants.{}.prices.{}".format(i, j), price
+
+
+def _batches(cursor, size):
+    while True:
+        batch = list(islice(cursor, size))
+        if not batch:
+            return
+        yield batch
+
+
+def reprice(margin=None, discount=None, fx_rate=None, currency=None, instance_id=None, query=None, batch_size=1000,
+            progress=None):
+    """
+    reprice every product of a tenant matching query
+
+    :param margin: see compute_prices
+    :param discount: see compute_prices
+    :param fx_rate: see compute_prices
+    :param currency: only reprice prices in this currency code
+    :param instance_id: the tenant whose catalog is repriced, without it every tenant is (a scatter-gather query)
+    :param query: raw filter on products, soft deleted products are skipped
+    :param batch_size: products per batch and per bulk_write
+    :param progress: called with the running stats after every batch
+    :return: stats dict with counts and throughput. Prices left as they are for lack of a profit margin are
+        counted in missing_margin, with the ids of (up to 100 of) their products in missing_margin_products
+    """
+    collection = Product._mongometa.collection
+    with tenant.tenant_scope(instance_id):
+        query = ProductService.scoped(query)
+    cursor = collection.find(query,
+                             projection={"price": 1, "variants.prices": 1, "variants.default_currency": 1},
+                             sort=[("_id", 1)], batch_size=batch_size)
+    rates = FxRate.table(fresh=True)
+
+    stats = {"products": 0, "prices": 0, "skipped": 0, "missing_margin": 0, "missing_margin_products": [],
+             "batches": 0}
+    started = time.monotonic()
+
+    for batch in _batches(cursor, batch_size):
+        owners, paths, prices = [], [], []
+        for doc in batch:
+            for path, price in _price_paths(doc):
+                if currency and price.get("currency") != currency:
+                    continue
+                owners.append(doc["_id"])
+                paths.append(path)
+                prices.append(price)
+
+        operations = []
+        if prices:
+            mask, fields = compute_prices(prices, margin=margin, discount=discount, fx_rate=fx_rate)
+            now = datetime.utcnow()
+            updates = {}
+            for index in np.flatnonzero(mask):
+                update = updates.setdefault(owners[index], {"last_updated": now})
+                for name, values in fields.items():
+                    value = float(values[index])
+                    if np.isnan(value):
+                        continue
+                    update["{}.{}".format(paths[index], name)] = value
+                    # prices reference the batch documents, which then hold the new values
+                    prices[index][name] = value
+
+            for doc in batch:
+                if doc["_id"] in updates:
+                    updates[doc["_id"]].update(normalized_prices(doc, rates))
+
+            operations = [UpdateOne({"_id": obj_id}, {"$set": update}) for obj_id, update in updates.items()]
+            if operations:
+                collection.bulk_write(operations, ordered=False)
+            missing_margin = np.flatnonzero(~np.isnan(fields["cost_value"]) & np.isnan(fields["profit_margin"]))
+            for index in missing_margin:
+                if len(stats["missing_margin_products"]) >= 100:
+                    break
+                if str(owners[index]) not in stats["missing_margin_products"]:
+                    stats["missing_margin_products"].append(str(owners[index]))
+            stats["prices"] += int(mask.sum())
+            stats["missing_margin"] += len(missing_margin)
+            stats["skipped"] += int((~mask).sum()) - len(missing_margin)
+
+        stats["products"] += len(operations)
+        stats["batches"] += 1
+        elapsed = time.monotonic() - started
+        stats["seconds"] = round(elapsed, 3)
+        stats["products_per_second"] = round(stats["products"] / elapsed, 1) if elapsed else None
+        stats["prices_per_second"] = round(stats["prices"] / elapsed, 1) if elapsed else None
+        if progress:
+            progress(dict(stats))
+
+    if stats["products"]:
+        cache.invalidate(Product)
+    return stats
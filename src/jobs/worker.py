@@ -0,0 +1,249 @@
+# coding=utf-8
+"""
+worker.py
+
+Background job workers.
+
+A pool of worker processes, separate from the web workers, polls the job collection, claims jobs atomically through
+JobService.claim and runs them. While a job runs, a heartbeat thread extends its lease every third of
+JOB_LEASE_SECONDS, whether or not the job reports progress; progress is written back at most once per
+PROGRESS_INTERVAL seconds. A job whose lease was lost (it expired, or another worker took the job over) is stopped
+at its next progress report and its outcome discarded. Failed jobs are retried with backoff by JobService.fail.
+
+    python admin.py worker --concurrency 4
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
+
+import settings
+from ..base import log, migrations
+from ..services.job import JobService
+
+logger = logging.getLogger(__name__)
+
+# seconds between two progress writes of a running job
+PROGRESS_INTERVAL = 1.0
+
+
+class LeaseLost(Exception):
+    """ raised from the progress callback of a job that is no longer held by its worker """
+
+
+def catalog_import(path, user_id, instance_id, fmt=None, report=None, batch_size=1000, workers=None,
+                   progress=None):
+    from .catalog_import import CatalogImport, open_rows
+
+    job = CatalogImport(user_id, instance_id, batch_size=batch_size, workers=workers, progress=progress,
+                        report=report)
+    stats = job.run(open_rows(path, fmt=fmt))
+    stats["errors"] = job.errors
+    return stats
+
+
+def catalog_export(path, fmt="ndjson", user_id=None, instance_id=None, batch_size=1000, progress=None):
+    from .catalog_export import CatalogExport
+
+    query = {}
+    if instance_id:
+        query["instance_id"] = instance_id
+    if user_id:
+        query["user"] = ObjectId(user_id)
+    return CatalogExport(fmt=fmt, query=query, batch_size=batch_size).to_file(path, progress=progress)
+
+
+def reprice(progress=None, **params):
+    from .repricing import reprice as run
+
+    return run(progress=progress, **params)
+
+
+def normalize_prices(progress=None, **params):
+    from .normalization import normalize_prices as run
+
+    return run(progress=progress, **params)
+
+
+def roll_up_sales(stale_after=300, batch_size=1000, progress=None):
+    from ..services.sales import SalesService
+
+    return SalesService.roll_up_pending(stale_after=stale_after, batch_size=batch_size, progress=progress)
+
+
+def archive_deleted(older_than_days=30, batch_size=500, collections=None, progress=None):
+    from .archival import archive
+
+    return archive(older_than_days=older_than_days, batch_size=batch_size, collections=collections,
+                   progress=progress)
+
+
+def backfill_soft_delete(collections=None, progress=None):
+    from .archival import backfill
+
+    return backfill(collections=collections, progress=progress)
+
+
+def reindex(progress=None):
+    """ create the declared indexes of every model """
+    from .. import models
+
+    created = {}
+    for model in vars(models).values():
+        meta = getattr(model, "_mongometa", None)
+        if isinstance(model, type) and issubclass(model, models.MongoModel) and meta and meta.indexes:
+            created[meta.collection_name] = meta.collection.create_indexes(meta.indexes)
+            if progress:
+                progress({"collections": len(created)})
+    return created
+
+
+# registered jobs: name -> callable taking the job params as keyword arguments and a progress callback
+JOBS = {
+    "catalog_import": catalog_import,
+    "catalog_export": catalog_export,
+    "reprice": reprice,
+    "normalize_prices": normalize_prices,
+    "roll_up_sales": roll_up_sales,
+    "reindex": reindex,
+    "archive_deleted": archive_deleted,
+    "backfill_soft_delete": backfill_soft_delete,
+}
+
+# most jobs of a name running at once across all workers
+JOB_LIMITS = {
+    "catalog_import": 2,
+    "catalog_export": 2,
+    "reprice": 1,
+    "normalize_prices": 1,
+    "roll_up_sales": 1,
+    "reindex": 1,
+    "archive_deleted": 1,
+    "backfill_soft_delete": 1,
+}
+
+
+class Worker(object):
+    """ claims and executes jobs one at a time """
+
+    def __init__(self, worker_id=None, names=None, poll_interval=None):
+        self.worker_id = worker_id or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.names = list(names or JOBS)
+        self.poll_interval = poll_interval or settings.JOB_POLL_INTERVAL_SECONDS
+
+    def run_once(self):
+        """
+        claim and run a single job
+
+        :return: True if a job was run
+        """
+        job = JobService.claim(self.worker_id, names=self.names, limits=JOB_LIMITS)
+        if not job:
+            return False
+        self.execute(job)
+        return True
+
+    def heartbeat(self, job, lost, stopped):
+        """ extend the lease of job until stopped is set, sets lost once the lease could not be extended """
+        while not stopped.wait(settings.JOB_LEASE_SECONDS / 3):
+            try:
+                if not JobService.extend_lease(job):
+                    lost.set()
+                    return
+            except PyMongoError as e:
+                # the lease is still valid for a while, the next beat retries
+                logger.warning("lease extension of job %s failed: %s", job.pk, e)
+
+    def execute(self, job):
+        """
+
+        :param job: a claimed job
+        """
+        func = JOBS.get(job.name)
+        if func is None:
+            job.max_attempts = job.attempts
+            JobService.fail(job, "unknown job {}".format(job.name))
+            return
+
+        reported = [0.0]
+        lost = threading.Event()
+
+        def progress(stats):
+            if lost.is_set():
+                raise LeaseLost(job.pk)
+            now = time.monotonic()
+            if now - reported[0] >= PROGRESS_INTERVAL:
+                reported[0] = now
+                if not JobService.report_progress(job, stats):
+                    lost.set()
+                    raise LeaseLost(job.pk)
+
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job, lost, stopped),
+                                     name="job-heartbeat-{}".format(job.pk), daemon=True)
+        heartbeat.start()
+        try:
+            result = func(progress=progress, **(job.params or {}))
+        except LeaseLost:
+            logger.warning("job %s (%s) lost its lease and was stopped", job.pk, job.name)
+            return
+        except Exception as e:
+            logger.exception("job %s (%s) failed", job.pk, job.name)
+            if not lost.is_set():
+                JobService.fail(job, "{}: {}".format(type(e).__name__, e))
+            return
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+        if lost.is_set():
+            logger.warning("job %s (%s) lost its lease, its result is discarded", job.pk, job.name)
+            return
+        JobService.complete(job, result)
+
+    def run(self, stop):
+        """ run jobs until stop is set """
+        migrations.apply()
+        while not stop.is_set():
+            if not self.run_once():
+                stop.wait(self.poll_interval)
+
+
+def _work(stop, names):
+    # the parent handles SIGINT/SIGTERM and sets stop, the running job finishes first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    Worker(names=names).run(stop)
+    # processes exit without running atexit handlers, write out the queued log records first
+    log.stop()
+
+
+def run_pool(concurrency=None, names=None):
+    """
+    Start concurrency worker processes and wait for them. The parent must not touch the database before forking,
+    each process opens its own connection.
+
+    :param concurrency: number of processes, defaults to JOB_WORKER_CONCURRENCY
+    :param names: only run jobs with these names
+    """
+    stop = multiprocessing.Event()
+    # not daemonic: jobs such as catalog_import start process pools of their own
+    processes = [multiprocessing.Process(target=_work, args=(stop, names), name="job-worker-{}".format(i))
+                 for i in range(concurrency or settings.JOB_WORKER_CONCURRENCY)]
+
+    def shutdown(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -12,16 +12,16 @@ import pymongo
 from pymongo.write_concern import WriteConcern
 from pymongo.operations import IndexModel
 from pymodm import connect, fields, MongoModel, EmbeddedMongoModel
+from pymodm.errors import ValidationError
 from datetime import datetime, timedelta
 from pymodm.common import _import as common_import
 import bcrypt
 import json
 import jwt
-from pprint import pprint
+import uuid
 
 # Must always be run before any other database calls can follow
 connect(settings.MONGO_DB_URI, connect=False, maxPoolSize=None)
-print(settings.MONGO_DB_URI)
 
 
 class ReferenceField(fields.ReferenceField):
@@ -55,6 +55,43 @@ class ReferenceField(fields.ReferenceField):
         return self.related_model._mongometa.pk.to_python(value)
 
 
+def reference_id(obj, name):
+    """
+    The stored id of a reference field, read without dereferencing it.
+
+    :param obj: model instance holding the reference
+    :param name: name of the reference field
+    :return: the referenced id, or None when unset
+    """
+    field = obj._mongometa.get_field(name)
+    if field is None or field.attname not in obj._data:
+        return None
+    value = obj._data.get_mongo_value(field.attname, field.to_mongo)
+    return getattr(value, "pk", value)
+
+
+def normalize_attributes(attributes):
+    """
+    Normalize variant attributes into a hashable key that ignores order and case.
+    Accepts {"size": "44", "color": "red"} style dicts as well as {"code": "size", "value": "44"} entries.
+
+    :param attributes: list of attribute dicts, or a single dict
+    :return: tuple of sorted (name, value) pairs
+    """
+    if isinstance(attributes, dict):
+        attributes = [attributes]
+
+    pairs = []
+    for attribute in attributes or []:
+        if not isinstance(attribute, dict):
+            continue
+        if "value" in attribute and ("code" in attribute or "name" in attribute):
+            pairs.append((attribute.get("code") or attribute.get("name"), attribute["value"]))
+        else:
+            pairs.extend(attribute.items())
+    return tuple(sorted((str(name).strip().lower(), str(value).strip().lower()) for name, value in pairs))
+
+
 class AppMixin:
     """ App mixin will hold special methods and field parameters to map to all model classes"""
 
@@ -72,6 +109,10 @@ class AppMixin:
         return self.__dict__
 
 
+ACCESS_TOKEN = "access"
+REFRESH_TOKEN = "refresh"
+
+
 class User(MongoModel, AppMixin):
     """ Model for storing information about an entity or user who owns an account or set of accounts.
     _id will be equivalent to either the user_id or the entity_id
@@ -81,6 +122,9 @@ class User(MongoModel, AppMixin):
     first_name = fields.CharField(required=False, blank=True)
     password = fields.CharField(required=False, blank=True)
     last_name = fields.CharField(required=False, blank=True)
+    instance_id = fields.CharField(required=False, blank=True)
+    deleted = fields.BooleanField(required=False, blank=True, default=False)
+    deleted_at = fields.DateTimeField(required=False, blank=True)
     date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
     last_updated = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
 
@@ -93,7 +137,10 @@ class User(MongoModel, AppMixin):
         ignore_unknown_fields = True
         indexes = [
             IndexModel([("_cls", pymongo.DESCENDING), ("email", pymongo.ASCENDING), ("first_name", pymongo.ASCENDING),
-                        ("last_name", pymongo.ASCENDING), ("date_created", pymongo.DESCENDING), ])]
+                        ("last_name", pymongo.ASCENDING), ("date_created", pymongo.DESCENDING), ]),
+            IndexModel([("instance_id", pymongo.ASCENDING), ("email", pymongo.ASCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            IndexModel([("deleted_at", pymongo.ASCENDING)], partialFilterExpression={"deleted": True})]
 
     def set_password(self, password):
         """
@@ -141,12 +188,29 @@ class User(MongoModel, AppMixin):
         if not self.pk:
             raise ValueError("Cannot generate token for unsaved object")
 
-        expires_in = datetime.now() + timedelta(hours=int(settings.JWT_EXPIRES_IN_HOURS))
+        return self.issue_token(ACCESS_TOKEN, timedelta(minutes=settings.JWT_ACCESS_EXPIRES_IN_MINUTES),
+                                first_name=self.first_name, last_name=self.last_name)
+
+    @property
+    def refresh_token(self):
+        """ Generate a refresh token, exchanged for a new pair of tokens at /token/refresh """
+
+        if not self.pk:
+            raise ValueError("Cannot generate token for unsaved object")
+
+        return self.issue_token(REFRESH_TOKEN, timedelta(days=settings.JWT_REFRESH_EXPIRES_IN_DAYS))
+
+    def issue_token(self, token_type, lifetime, **claims):
+        """
+        a signed token of token_type for this user. Every token carries a unique jti so it can be revoked, and its
+        issue time in milliseconds (iat_ms) so a revocation of every token of the user spares those issued right after
+        it within the same second
+        """
 
-        payload = dict(first_name=self.first_name, last_name=self.last_name, id=str(self.pk), exp=expires_in)
-        # print(payload, "token the payload")
-        encoded = jwt.encode(payload, key=settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
-        return encoded
+        now = datetime.utcnow()
+        payload = dict(claims, id=str(self.pk), instance_id=self.instance_id, type=token_type, jti=uuid.uuid4().hex,
+                       iat=now, iat_ms=int((now - datetime(1970, 1, 1)).total_seconds() * 1000), exp=now + lifetime)
+        return jwt.encode(payload, key=settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
 
 
 class Address(EmbeddedMongoModel, AppMixin):
@@ -169,6 +233,93 @@ class Currency(MongoModel, AppMixin):
     date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
     last_updated = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
 
+    @classmethod
+    def table(cls):
+        """
+        currency code -> {"code", "name", "symbol"}, cached so prices can be shown without dereferencing currencies
+
+        @return: dict
+        """
+        from .base import cache
+
+        key = cache.make_key("currencies", models=[cls])
+        currencies = cache.get_cache().get(key)
+        if currencies is None:
+            currencies = {doc["_id"]: {"code": doc["_id"], "name": doc.get("name"), "symbol": doc.get("symbol")}
+                          for doc in cls._mongometa.collection.find({})}
+            cache.get_cache().set(key, currencies, ttl=settings.FX_RATES_TTL_SECONDS)
+        return currencies
+
+
+class FxRate(MongoModel, AppMixin):
+    """
+    Exchange rate of a currency to settings.BASE_CURRENCY: one unit of currency is worth rate units of the base
+    currency. Used to maintain the normalized prices of products, see FxService.set_rate.
+    """
+    currency = fields.CharField(primary_key=True)
+    rate = fields.FloatField(required=True, blank=False)
+    last_updated = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+
+    @classmethod
+    def table(cls, fresh=False):
+        """
+        currency code -> rate, including the base currency. Cached for FX_RATES_TTL_SECONDS: with the local cache
+        backend, FxService.set_rate only invalidates the copy of the process that called it, other processes see the
+        new rate once their copy expires. Jobs writing normalized prices pass fresh=True.
+
+        @param fresh: read the rates from the collection rather than the cache
+        @return: dict
+        """
+        from .base import cache
+
+        key = cache.make_key("fx_rates", models=[cls])
+        rates = None if fresh else cache.get_cache().get(key)
+        if rates is None:
+            rates = {doc["_id"]: doc["rate"] for doc in cls._mongometa.collection.find({}, {"rate": 1})}
+            rates[settings.BASE_CURRENCY] = 1.0
+            cache.get_cache().set(key, rates, ttl=settings.FX_RATES_TTL_SECONDS)
+        return rates
+
+
+def normalize_price(price, rates):
+    """
+    value of a raw price document in the base currency
+
+    :param price: price sub document, its currency as a code
+    :param rates: FxRate.table()
+    :return: float, or None when the price or the rate of its currency is unknown
+    """
+    if not price or price.get("value") is None or not rates.get(price.get("currency")):
+        return None
+    return round(price["value"] * rates[price["currency"]], 4)
+
+
+def normalized_prices(doc, rates):
+    """
+    normalized prices of a raw product document: each variant is valued at its price in its default currency (its
+    first price otherwise), the product at its own price, or its cheapest variant when it has none
+
+    :param doc: product document, or a dict with its price and variants
+    :param rates: FxRate.table()
+    :return: dict of field path -> value, suitable for $set
+    """
+    fields_ = {}
+    variant_values = []
+    for i, variant in enumerate(doc.get("variants") or []):
+        prices = variant.get("prices") or []
+        price = next((price for price in prices if price.get("currency") == variant.get("default_currency")),
+                     prices[0] if prices else None)
+        value = normalize_price(price, rates)
+        fields_["variants.{}.normalized_price".format(i)] = value
+        if value is not None:
+            variant_values.append(value)
+
+    value = normalize_price(doc.get("price"), rates)
+    if value is None and variant_values:
+        value = min(variant_values)
+    fields_["normalized_price"] = value
+    return fields_
+
 
 class Price(EmbeddedMongoModel, AppMixin):
     """
@@ -181,6 +332,10 @@ class Price(EmbeddedMongoModel, AppMixin):
     currency = ReferenceField(Currency, required=True, blank=False)
     mrsp_value = fields.FloatField(required=False, blank=True)
     profit_margin = fields.FloatField(required=False, blank=True)
+    # cost and mrsp as recorded, before conversion to the price currency with fx_rate
+    source_cost_value = fields.FloatField(required=False, blank=True)
+    source_mrsp_value = fields.FloatField(required=False, blank=True)
+    fx_rate = fields.FloatField(required=False, blank=True)
 
     class Meta:
         """
@@ -204,9 +359,24 @@ class Category(MongoModel, AppMixin):
     eligible = fields.BooleanField(blank=True, default=True)
     relevance = fields.IntegerField(required=False, blank=True)
     commission = fields.FloatField(required=False, default=None, blank=True)
+    deleted = fields.BooleanField(required=False, blank=True, default=False)
+    deleted_at = fields.DateTimeField(required=False, blank=True)
     date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
     last_updated = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
 
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
+
+        indexes = [
+            IndexModel([("instance_id", pymongo.ASCENDING), ("code", pymongo.ASCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            IndexModel([("deleted_at", pymongo.ASCENDING)], partialFilterExpression={"deleted": True})
+        ]
+
     @property
     def sub_categories(self):
         """
@@ -214,7 +384,7 @@ class Category(MongoModel, AppMixin):
         @return: sub categoriees
         @rtype: MongoModel
         """
-        return SubCategory.objects.raw({"category": self.pk})
+        return SubCategory.objects.raw({"instance_id": self.instance_id, "category": self.pk, "deleted": False})
 
     @property
     def product_count(self):
@@ -222,8 +392,8 @@ class Category(MongoModel, AppMixin):
 
         @return:
         """
-        return Product.objects.raw({"category_code": self.code,
-                                    "instance_id": self.instance_id}).only("_id").count()
+        return Product.objects.raw({"instance_id": self.instance_id, "category": self.pk,
+                                    "deleted": False}).only("_id").count()
 
 
 class SubCategory(MongoModel, AppMixin):
@@ -240,9 +410,24 @@ class SubCategory(MongoModel, AppMixin):
     category_code = fields.CharField(required=False, blank=True)
     visible = fields.BooleanField(blank=True, default=True)
     eligible = fields.BooleanField(blank=True, default=True)
+    deleted = fields.BooleanField(required=False, blank=True, default=False)
+    deleted_at = fields.DateTimeField(required=False, blank=True)
     date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
     last_updated = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
 
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
+
+        indexes = [
+            IndexModel([("instance_id", pymongo.ASCENDING), ("category", pymongo.ASCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            IndexModel([("deleted_at", pymongo.ASCENDING)], partialFilterExpression={"deleted": True})
+        ]
+
 
 class Country(MongoModel, AppMixin):
     code = fields.CharField(primary_key=True)
@@ -273,9 +458,13 @@ class Location(MongoModel, AppMixin):
     post_code = fields.CharField(required=False, blank=True)
     lat = fields.FloatField(required=False, blank=True)
     lng = fields.FloatField(required=False, blank=True)
+    point = fields.PointField(required=False, blank=True)  # GeoJSON copy of lat/lng, maintained on save
     default = fields.BooleanField(blank=True, default=False)
     user_id = fields.CharField(required=False, blank=True)
     user = fields.ReferenceField(User, required=True, blank=False)
+    instance_id = fields.CharField(required=False, blank=True)
+    deleted = fields.BooleanField(required=False, blank=True, default=False)
+    deleted_at = fields.DateTimeField(required=False, blank=True)
     date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
     last_updated = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
 
@@ -287,21 +476,36 @@ class Location(MongoModel, AppMixin):
         ignore_unknown_fields = True
 
         indexes = [
-            IndexModel([('domain', pymongo.ASCENDING), ('email', pymongo.ASCENDING),
-                        ('instance_id', pymongo.ASCENDING), ('phone', pymongo.ASCENDING),
+            IndexModel([('instance_id', pymongo.ASCENDING), ('domain', pymongo.ASCENDING),
+                        ('email', pymongo.ASCENDING), ('phone', pymongo.ASCENDING),
                         ("date_created", pymongo.DESCENDING)]),
-            IndexModel([('domain', pymongo.ASCENDING), ('instance_id', pymongo.ASCENDING)],
+            IndexModel([('instance_id', pymongo.ASCENDING), ('domain', pymongo.ASCENDING)],
                        partialFilterExpression={"domain": {"$type": "string"}},
-                       unique=True)
+                       unique=True),
+            IndexModel([('instance_id', pymongo.ASCENDING), ('point', pymongo.GEOSPHERE)]),
+            IndexModel([("instance_id", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING),
+                        ("date_created", pymongo.DESCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            IndexModel([("deleted_at", pymongo.ASCENDING)], partialFilterExpression={"deleted": True})
         ]
 
+    def clean(self):
+        """ keep the GeoJSON point in sync with lat/lng so the 2dsphere index can serve distance queries """
+
+        if self.lat is None or self.lng is None:
+            del self.point
+            return
+        if not (-90 <= self.lat <= 90 and -180 <= self.lng <= 180):
+            raise ValidationError("lat/lng out of range")
+        self.point = {"type": "Point", "coordinates": [self.lng, self.lat]}
+
     @property
     def product_count(self):
         """
 
         @return:
         """
-        return Product.objects.raw({"location": self.pk}).count()
+        return Product.objects.raw({"instance_id": self.instance_id, "location": self.pk, "deleted": False}).count()
 
 
 class ProductStat(EmbeddedMongoModel):
@@ -353,6 +557,7 @@ class ProductVariant(EmbeddedMongoModel, AppMixin):
                                   blank=True)  # {'size': '44', 'color': 'red', 'fit': 'slim|regular|skinny'}
     available = fields.BooleanField(required=False, blank=True)
     default_currency = ReferenceField(Currency, required=False, blank=True)
+    normalized_price = fields.FloatField(required=False, blank=True)  # price in settings.BASE_CURRENCY
 
     class Meta:
         """
@@ -388,13 +593,43 @@ class ProductVariant(EmbeddedMongoModel, AppMixin):
     @property
     def price(self):
         """
-        Price
+        Price in the default currency of the variant, or its first price when there is no match
         """
-        default_currency = self.default_currency
-        for price in self.prices:
-            if price.currency.code == default_currency.code:
+        default_currency = reference_id(self, "default_currency")
+        prices = self.prices or []
+        for price in prices:
+            if reference_id(price, "currency") == default_currency:
                 return price
-        return self.price
+        return prices[0] if prices else None
+
+
+class VariantIndex(object):
+    """
+    Lookup tables over the variants of a single product, built once so cart and product page code does not scan
+    Product.variants for every lookup.
+    """
+
+    def __init__(self, variants):
+        self.by_sku = {}
+        self.by_attributes = {}
+        self.prices = {}
+        for variant in variants or []:
+            if variant.sku:
+                self.by_sku[variant.sku] = variant
+                self.prices[variant.sku] = {reference_id(price, "currency"): price for price in variant.prices or []}
+            self.by_attributes.setdefault(normalize_attributes(variant.attributes), variant)
+
+    def find(self, sku=None, **attributes):
+        """
+        The variant with the given sku, or the one matching the attribute combination e.g. size="44", color="red"
+        """
+        if sku:
+            return self.by_sku.get(sku)
+        return self.by_attributes.get(normalize_attributes(attributes))
+
+    def price(self, sku, currency):
+        """ price of a variant in a currency code """
+        return self.prices.get(sku, {}).get(currency)
 
 
 class Product(AppMixin, MongoModel):
@@ -412,6 +647,7 @@ class Product(AppMixin, MongoModel):
     quantity = fields.IntegerField(required=True, blank=False, default=1)
     unlimited_stock = fields.BooleanField(blank=True, default=False)
     user = fields.ReferenceField(User, required=True, blank=False)
+    instance_id = fields.CharField(required=False, blank=True)
     tags = fields.ListField(fields.CharField(), required=False, blank=True, default=[])
     attributes = fields.EmbeddedDocumentListField(EmbeddedAttribute, required=False, blank=True)
     variants = fields.EmbeddedDocumentListField(ProductVariant, required=False, blank=True)
@@ -421,5 +657,272 @@ class Product(AppMixin, MongoModel):
     visible = fields.BooleanField(blank=True, default=True)
     has_variations = fields.BooleanField(blank=True, default=False)
     supplier = fields.DictField(required=False, blank=True)
+    # price in settings.BASE_CURRENCY, kept in sync on save and by the normalize_prices job when rates change
+    normalized_price = fields.FloatField(required=False, blank=True)
+    deleted = fields.BooleanField(required=False, blank=True, default=False)
+    deleted_at = fields.DateTimeField(required=False, blank=True)
     date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
     last_updated = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
+
+        indexes = [
+            IndexModel([("instance_id", pymongo.ASCENDING), ("variants.sku", pymongo.ASCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            # price sort and price range filters of listings, _id breaks ties so pages are stable
+            IndexModel([("instance_id", pymongo.ASCENDING), ("normalized_price", pymongo.ASCENDING),
+                        ("_id", pymongo.ASCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            IndexModel([("instance_id", pymongo.ASCENDING), ("category", pymongo.ASCENDING),
+                        ("normalized_price", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            IndexModel([("instance_id", pymongo.ASCENDING), ("user", pymongo.ASCENDING),
+                        ("normalized_price", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            # joined from locations by $lookup, which only matches on location
+            IndexModel([("location", pymongo.ASCENDING)]),
+            IndexModel([("instance_id", pymongo.ASCENDING), ("category", pymongo.ASCENDING),
+                        ("sub_category", pymongo.ASCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            IndexModel([("instance_id", pymongo.ASCENDING), ("user", pymongo.ASCENDING),
+                        ("date_created", pymongo.DESCENDING)],
+                       partialFilterExpression={"deleted": False}),
+            # covers deleted products too, a deleted product keeps its sku until archived
+            IndexModel([("instance_id", pymongo.ASCENDING), ("user", pymongo.ASCENDING), ("sku", pymongo.ASCENDING)],
+                       unique=True, partialFilterExpression={"sku": {"$type": "string"}}),
+            IndexModel([("deleted_at", pymongo.ASCENDING)], partialFilterExpression={"deleted": True})
+        ]
+
+    def __setattr__(self, name, value):
+        if name == "variants":
+            self.__dict__.pop("_variant_index", None)
+        super(Product, self).__setattr__(name, value)
+
+    def clean(self):
+        """ keep the normalized prices in sync with the prices """
+
+        def raw(price):
+            return {"value": price.value, "currency": reference_id(price, "currency")} if price else None
+
+        doc = {"price": raw(self.price),
+               "variants": [{"default_currency": reference_id(variant, "default_currency"),
+                             "prices": [raw(price) for price in variant.prices or []]}
+                            for variant in self.variants or []]}
+        values = normalized_prices(doc, FxRate.table())
+        self.normalized_price = values["normalized_price"]
+        for i, variant in enumerate(self.variants or []):
+            variant.normalized_price = values["variants.{}.normalized_price".format(i)]
+
+    @property
+    def variant_index(self):
+        """
+        Variant lookups by sku, attribute combination and currency. Built on first use and kept with the product
+        until its variants are replaced.
+
+        @return: VariantIndex
+        """
+        index = self.__dict__.get("_variant_index")
+        if index is None:
+            index = self.__dict__["_variant_index"] = VariantIndex(self.variants)
+        return index
+
+
+class Job(MongoModel, AppMixin):
+    """
+    A unit of background work, claimed and executed by the worker processes (see src/jobs/worker.py)
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+    name = fields.CharField(required=True, blank=False)
+    params = fields.DictField(required=False, blank=True)
+    status = fields.CharField(required=True, blank=False, default=QUEUED,
+                              choices=(QUEUED, RUNNING, COMPLETED, FAILED))
+    attempts = fields.IntegerField(required=True, blank=False, default=0)
+    max_attempts = fields.IntegerField(required=True, blank=False, default=3)
+    progress = fields.DictField(required=False, blank=True)
+    result = fields.DictField(required=False, blank=True)
+    error = fields.CharField(required=False, blank=True)
+    user_id = fields.CharField(required=False, blank=True)
+    worker_id = fields.CharField(required=False, blank=True)
+    run_at = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+    lease_expires_at = fields.DateTimeField(required=False, blank=True)
+    # concurrency slot ("<name>:<n>") held while a job with a concurrency limit runs
+    slot = fields.CharField(required=False, blank=True)
+    started_at = fields.DateTimeField(required=False, blank=True)
+    finished_at = fields.DateTimeField(required=False, blank=True)
+    date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+    last_updated = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
+
+        indexes = [
+            IndexModel([("status", pymongo.ASCENDING), ("run_at", pymongo.ASCENDING)]),
+            IndexModel([("status", pymongo.ASCENDING), ("lease_expires_at", pymongo.ASCENDING)]),
+            IndexModel([("user_id", pymongo.ASCENDING), ("date_created", pymongo.DESCENDING)]),
+            IndexModel([("slot", pymongo.ASCENDING)], unique=True,
+                       partialFilterExpression={"slot": {"$exists": True}})
+        ]
+
+
+class IdempotencyKey(MongoModel, AppMixin):
+    """
+    The outcome of a POST sent with an Idempotency-Key header, replayed to retries of the same request
+    (see src/base/idempotency.py). Removed by a TTL index once expires_at is reached.
+    """
+    IN_FLIGHT = "in_flight"
+    COMPLETED = "completed"
+
+    key = fields.CharField(primary_key=True)
+    fingerprint = fields.CharField(required=True, blank=False)
+    status = fields.CharField(required=True, blank=False, default=IN_FLIGHT, choices=(IN_FLIGHT, COMPLETED))
+    status_code = fields.IntegerField(required=False, blank=True)
+    body = fields.CharField(required=False, blank=True)
+    # [name, value] pairs
+    headers = fields.ListField(required=False, blank=True)
+    locked_until = fields.DateTimeField(required=False, blank=True)
+    expires_at = fields.DateTimeField(required=True, blank=False)
+    date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
+
+        indexes = [
+            IndexModel([("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0)
+        ]
+
+
+class SaleEvent(MongoModel, AppMixin):
+    """
+    A product sale, as recorded by SalesService.record_sales. Sales are also added to SalesRollup buckets as they are
+    recorded, dashboards never read events. rollup is set until the event is added to the rollups: "pending", then
+    the id of the claim of the process adding it.
+    """
+    ROLLUP_PENDING = "pending"
+
+    product = fields.ObjectIdField(required=True, blank=False)
+    seller = fields.ObjectIdField(required=True, blank=False)
+    variant_sku = fields.CharField(required=False, blank=True)
+    order_id = fields.CharField(required=False, blank=True)
+    quantity = fields.IntegerField(required=True, blank=False, default=1)
+    amount = fields.FloatField(required=True, blank=False, default=0)
+    currency = fields.CharField(required=False, blank=True)
+    instance_id = fields.CharField(required=False, blank=True)
+    sold_at = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+    rollup = fields.CharField(required=False, blank=True)
+    rollup_claimed_at = fields.DateTimeField(required=False, blank=True)
+    date_created = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
+
+        indexes = [
+            IndexModel([("instance_id", pymongo.ASCENDING), ("seller", pymongo.ASCENDING),
+                        ("sold_at", pymongo.DESCENDING)]),
+            # only events not rolled up yet, found again by the roll_up_sales job
+            IndexModel([("rollup", pymongo.ASCENDING), ("rollup_claimed_at", pymongo.ASCENDING)],
+                       partialFilterExpression={"rollup": {"$exists": True}}),
+            IndexModel([("product", pymongo.ASCENDING), ("sold_at", pymongo.DESCENDING)]),
+            # an order line recorded twice is only counted once
+            IndexModel([("instance_id", pymongo.ASCENDING), ("order_id", pymongo.ASCENDING),
+                        ("product", pymongo.ASCENDING), ("variant_sku", pymongo.ASCENDING)],
+                       unique=True, partialFilterExpression={"order_id": {"$type": "string"}})
+        ]
+
+
+class SalesRollup(MongoModel, AppMixin):
+    """
+    Sales of a product or of a seller over an hour or a day, incremented with upserts as sales are recorded.
+    amounts holds the total sold per currency code.
+    """
+    PRODUCT = "product"
+    SELLER = "seller"
+    HOUR = "hour"
+    DAY = "day"
+
+    instance_id = fields.CharField(required=False, blank=True)
+    scope = fields.CharField(required=True, blank=False, choices=(PRODUCT, SELLER))
+    owner = fields.ObjectIdField(required=True, blank=False)
+    granularity = fields.CharField(required=True, blank=False, choices=(HOUR, DAY))
+    bucket = fields.DateTimeField(required=True, blank=False)
+    units = fields.IntegerField(required=True, blank=False, default=0)
+    sales = fields.IntegerField(required=True, blank=False, default=0)
+    amounts = fields.DictField(required=False, blank=True)
+    expires_at = fields.DateTimeField(required=False, blank=True)
+
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
+
+        indexes = [
+            IndexModel([("instance_id", pymongo.ASCENDING), ("scope", pymongo.ASCENDING), ("owner", pymongo.ASCENDING),
+                        ("granularity", pymongo.ASCENDING), ("bucket", pymongo.ASCENDING)], unique=True),
+            # hourly buckets are only kept for SALES_HOURLY_RETENTION_DAYS
+            IndexModel([("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0,
+                       partialFilterExpression={"granularity": "hour"})
+        ]
+
+
+class RevokedToken(MongoModel, AppMixin):
+    """
+    A revoked token (jti), or every token of a user issued before revoked_at (user_id). Kept until the tokens it
+    covers would have expired anyway, then removed by a TTL index. Mirrored in memory by src/base/revocation.py.
+    """
+
+    jti = fields.CharField(required=False, blank=True)
+    user_id = fields.CharField(required=False, blank=True)
+    revoked_at = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+    expires_at = fields.DateTimeField(required=True, blank=False)
+
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
+
+        indexes = [
+            IndexModel([("jti", pymongo.ASCENDING)], unique=True, partialFilterExpression={"jti": {"$type": "string"}}),
+            IndexModel([("revoked_at", pymongo.ASCENDING)]),
+            IndexModel([("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0)
+        ]
+
+
+class Migration(MongoModel, AppMixin):
+    """
+    A data migration applied to the database (see src/base/migrations.py)
+    """
+
+    name = fields.CharField(primary_key=True)
+    result = fields.DictField(required=False, blank=True)
+    applied_at = fields.DateTimeField(required=True, blank=False, default=datetime.utcnow)
+
+    class Meta:
+        """
+        Meta
+        """
+        write_concern = WriteConcern(j=True)
+        ignore_unknown_fields = True
@@ -1,7 +1,10 @@
-from flask import make_response, abort
+from flask import make_response, abort, request
+from marshmallow import EXCLUDE, ValidationError
 
-from src.schemas import RegistrationSchema, UserResponseSchema, LoginSchema, LoginResponseSchema
+from src.schemas import RegistrationSchema, UserResponseSchema, LoginSchema, LoginResponseSchema, \
+    RefreshTokenSchema, LogoutSchema
 from src.base.resource import BaseResource
+from src.base.tenant import any_tenant
 
 
 class RegisterResource(BaseResource):
@@ -34,6 +37,9 @@ class LoginResource(BaseResource):
         "response": LoginResponseSchema
     }
 
+    # logging in twice is harmless, and tokens are not worth keeping around for replays
+    idempotent = False
+
     def get(self, obj_id=None):
         abort(400)
 
@@ -48,8 +54,75 @@ class LoginResource(BaseResource):
         :rtype:
         """
         email = data.get("email")
-        user = self.service_klass.find_one({"email": email})
+        # without X-Instance-Id the user is looked up by email across tenants, the token then carries the tenant.
+        # An email registered in several tenants is ambiguous, the client has to name the tenant
+        with any_tenant():
+            users = list(self.service_klass.query({"email": email}).limit(2))
 
+        if not users:
+            abort(409, {"err": "invalid email supplied"})
+        if len(users) > 1:
+            abort(409, {"err": "this email is registered with several instances, send X-Instance-Id"})
+        user = users[0]
         if not user.check_password(data.get("password")):
             abort(409, {"err": "invalid password supplied"})
         return user
+
+
+class RefreshTokenResource(BaseResource):
+    """
+    Exchanges a refresh token for a new access token and refresh token
+    """
+
+    serializers = {
+        "default": RefreshTokenSchema,
+        "response": LoginResponseSchema
+    }
+
+    idempotent = False
+
+    def get(self, obj_id=None):
+        abort(400)
+
+    def save(self, data, user_context=None):
+        """
+
+        :param data:
+        :type data:
+        :param user_context:
+        :type user_context:
+        :return:
+        :rtype:
+        """
+        try:
+            return self.service_klass.refresh(data.get("refresh_token"))
+        except ValueError:
+            abort(401, {"desc": "invalid refresh token"})
+
+
+class LogoutResource(BaseResource):
+    """
+    Revokes the access token of the request, and the refresh token of the session when sent along
+    """
+
+    serializers = {"default": LogoutSchema}
+
+    idempotent = False
+
+    def get(self, obj_id=None):
+        abort(400)
+
+    def post(self):
+        """
+
+        :return:
+        :rtype:
+        """
+        try:
+            data = self.serializers.get("default")().load(data=request.json or {}, unknown=EXCLUDE)
+        except ValidationError as e:
+            return abort(409, e.messages)
+
+        self.service_klass.logout(request.environ.get("user_context"), refresh_token=data.get("refresh_token"),
+                                  everywhere=data.get("everywhere"))
+        return {"status": "successful"}
@@ -0,0 +1,36 @@
+from flask import abort
+
+from src.schemas import CartQuoteSchema, CartQuoteResponseSchema
+from src.base.resource import BaseResource
+
+
+class CartQuoteResource(BaseResource):
+    """
+    Prices and availability of the lines of a cart. Nothing is stored, posting the same cart twice is harmless.
+    """
+
+    serializers = {"default": CartQuoteSchema,
+                   "response": CartQuoteResponseSchema}
+
+    idempotent = False
+
+    def get(self, obj_id=None):
+        abort(400)
+
+    def put(self, obj_id=None):
+        abort(400)
+
+    def delete(self, obj_id=None):
+        abort(400)
+
+    def save(self, data, user_context=None):
+        """
+
+        :param data:
+        :type data:
+        :param user_context:
+        :type user_context:
+        :return:
+        :rtype:
+        """
+        return self.service_klass.quote(data["lines"], currency=data.get("currency"))
@@ -0,0 +1,42 @@
+from flask import request, abort
+from datetime import datetime
+
+from src.base.resource import BaseResource
+from src.base.tenant import get_instance_id
+
+
+class CategoryTreeResource(BaseResource):
+    """
+    The whole category navigation tree of an instance, built and cached by CategoryService.tree
+    """
+
+    serializers = {}
+
+    cache_control = "public, max-age=60"
+
+    # the tenant comes from the token or X-Instance-Id, a shared cache must not serve one tenant's tree to another
+    vary = ("Authorization", "X-Instance-Id")
+
+    def post(self):
+        abort(400)
+
+    def put(self, obj_id=None):
+        abort(400)
+
+    def delete(self, obj_id=None):
+        abort(400)
+
+    def get(self, obj_id=None):
+        """
+
+        :return:
+        :rtype:
+        """
+        instance_id = get_instance_id() or request.args.get("instance_id")
+        if not instance_id:
+            return abort(409, {"instance_id": ["Missing data for required field."]})
+
+        entry = self.service_klass.tree(instance_id)
+        last_modified = datetime.fromisoformat(entry["last_modified"]) if entry.get("last_modified") else None
+        return self.conditional_response(lambda: {"data": entry["data"]}, etag=entry["etag"],
+                                         last_modified=last_modified)
@@ -0,0 +1,21 @@
+from flask import abort
+
+from src.schemas import JobResponseSchema
+from src.base.resource import BaseResource
+
+
+class JobResource(BaseResource):
+    """
+    Status of background jobs. Jobs are created by the application or the admin commands, never through this resource
+    """
+
+    serializers = {"response": JobResponseSchema}
+
+    def post(self):
+        abort(400)
+
+    def put(self, obj_id=None):
+        abort(400)
+
+    def delete(self, obj_id=None):
+        abort(400)
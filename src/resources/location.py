@@ -0,0 +1,72 @@
+from flask import request, abort
+from marshmallow import EXCLUDE, ValidationError
+
+from src.schemas import LocationRequestSchema, LocationResponseSchema, NearbySchema
+from src.base.resource import BaseResource
+
+
+class LocationResource(BaseResource):
+    """
+
+    """
+
+    serializers = {"default": LocationRequestSchema,
+                   "response": LocationResponseSchema}
+
+    def save(self, data, user_context=None):
+        """
+
+        :param data:
+        :type data:
+        :param user_context:
+        :type user_context:
+        :return:
+        :rtype:
+        """
+        user_id = user_context.get("id")
+        return self.service_klass.create(user=self.service_klass._prepare_id(user_id), user_id=user_id, **data)
+
+
+class NearbyResource(BaseResource):
+    """
+    Distance search around a point. Results are sorted by distance and paged with the distance and id of the last
+    result of the previous page.
+    """
+
+    serializers = {"default": NearbySchema,
+                   "response": LocationResponseSchema}
+
+    # service method running the search
+    search_method = "nearest"
+
+    def post(self):
+        abort(400)
+
+    def put(self, obj_id=None):
+        abort(400)
+
+    def delete(self, obj_id=None):
+        abort(400)
+
+    def get(self, obj_id=None):
+        """
+
+        :return:
+        :rtype:
+        """
+        try:
+            params = self.serializers.get("default")().load(data=request.args, unknown=EXCLUDE)
+        except ValidationError as e:
+            return abort(409, e.messages)
+
+        search = getattr(self.service_klass, self.search_method)
+        results = search(params["lng"], params["lat"], limit=params["limit"], max_distance=params.get("radius"),
+                         after_distance=params.get("after_distance"), after_id=params.get("after_id"))
+
+        next_page = None
+        if len(results) == params["limit"]:
+            last = results[-1]
+            next_page = {"after_distance": last.distance, "after_id": str(last.pk)}
+
+        schema = self.serializers.get("response")
+        return {"data": schema().dump(results, many=True), "next": next_page}
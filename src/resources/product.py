@@ -1,5 +1,13 @@
-from src.schemas import ProductRequestSchema, ProductResponseSchema
+from bson.objectid import ObjectId
+from flask import request, abort, Response, stream_with_context
+from marshmallow import EXCLUDE, ValidationError
+
+from src.schemas import ProductRequestSchema, ProductResponseSchema, ProductEventSchema, NearbySchema, \
+    ProductListSchema
 from src.base.resource import BaseResource
+from src.models import reference_id
+from src.resources.location import NearbyResource
+from src.jobs.catalog_export import CatalogExport
 
 
 class ProductResource(BaseResource):
@@ -9,3 +17,121 @@ class ProductResource(BaseResource):
 
     serializers = {"default": ProductRequestSchema,
                    "response": ProductResponseSchema}
+
+    cache_timeout = 60
+
+    def query(self):
+        """ products filtered by category and base currency price range, optionally sorted by price """
+        try:
+            params = ProductListSchema().load(data=request.args, unknown=EXCLUDE)
+        except ValidationError as e:
+            return abort(409, e.messages)
+        return self.service_klass.listing(category=params.get("category"), min_price=params.get("min_price"),
+                                          max_price=params.get("max_price"), sort=params.get("sort"))
+
+    def limit_query(self, query, **kwargs):
+        """ sellers see their own products """
+        user_context = request.environ.get("user_context")
+        if not user_context:
+            return query
+        return query.raw({"user": self.service_klass._prepare_id(user_context.get("id"))})
+
+    def limit_get(self, obj, **kwargs):
+        """ a product can only be viewed by the seller owning it """
+        user_context = request.environ.get("user_context") or {}
+        if str(reference_id(obj, "user")) == user_context.get("id"):
+            return obj
+        return abort(401, {"desc": "unauthorized"})
+
+    def save(self, data, user_context=None):
+        """
+
+        :param data:
+        :type data:
+        :param user_context:
+        :type user_context:
+        :return:
+        :rtype:
+        """
+        return self.service_klass.register(user=self.service_klass._prepare_id(user_context.get("id")), **data)
+
+
+class NearbyProductResource(NearbyResource):
+    """
+    Products sold from locations near a point
+    """
+
+    serializers = {"default": NearbySchema,
+                   "response": ProductResponseSchema}
+
+    search_method = "near"
+
+
+class ProductEventResource(BaseResource):
+    """
+    Ingests product page events (views, likes). Counters are buffered per worker and flushed in bulk, so the product
+    itself is never loaded or saved here.
+    """
+
+    serializers = {"default": ProductEventSchema}
+
+    def get(self, obj_id=None):
+        abort(400)
+
+    def post(self, obj_id=None):
+        """
+
+        :param obj_id: id of the product
+        :return:
+        :rtype:
+        """
+        serializer = self.serializers.get("default")
+
+        try:
+            validated_data = serializer().load(data=request.json, unknown=EXCLUDE)
+        except ValidationError as e:
+            return abort(409, e.messages)
+
+        if not self.service_klass.record_event(obj_id, validated_data["event"]):
+            return abort(404, {"desc": "requested object does not exist"})
+        return {"status": "accepted"}, 202
+
+
+class ProductExportResource(BaseResource):
+    """
+    Streams the products of the requesting seller as gzip compressed NDJSON or CSV. Memory stays flat whatever the
+    catalog size; an interrupted download is resumed by passing the _id of the last product received as after_id.
+    """
+
+    serializers = {}
+
+    def post(self):
+        abort(400)
+
+    def put(self, obj_id=None):
+        abort(400)
+
+    def delete(self, obj_id=None):
+        abort(400)
+
+    def get(self, obj_id=None):
+        """
+
+        :return:
+        :rtype:
+        """
+        fmt = request.args.get("format", "ndjson")
+        if fmt not in CatalogExport.content_types:
+            return abort(409, {"format": ["Must be one of: {}.".format(", ".join(CatalogExport.content_types))]})
+
+        # checked before streaming starts, a failure inside the stream would only truncate the download
+        after_id = request.args.get("after_id")
+        if after_id and not ObjectId.is_valid(after_id):
+            return abort(400, {"after_id": ["Not a valid product id."]})
+
+        user_id = request.environ.get("user_context", {}).get("id")
+        query = self.service_klass.scoped({"user": self.service_klass._prepare_id(user_id)})
+        export = CatalogExport(fmt=fmt, query=query)
+        chunks = export.chunks(after_id=after_id, compress=True)
+        return Response(stream_with_context(chunks), mimetype="application/gzip",
+                        headers={"Content-Disposition": "attachment; filename=products.{}.gz".format(fmt)})
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta, timezone
+
+from flask import request, abort
+from marshmallow import EXCLUDE, ValidationError
+
+from src.schemas import SalesDashboardSchema, SalesBucketSchema
+from src.base.resource import BaseResource
+from src.services.product import ProductService
+import settings
+
+
+class SalesDashboardResource(BaseResource):
+    """
+    Sales of the requesting seller, or of one of their products, per hour or day. Served from the sales rollups only.
+    """
+
+    serializers = {"default": SalesDashboardSchema,
+                   "response": SalesBucketSchema}
+
+    def get(self, obj_id=None):
+        """
+
+        :return:
+        :rtype:
+        """
+        try:
+            params = self.serializers.get("default")().load(data=request.args, unknown=EXCLUDE)
+        except ValidationError as e:
+            return abort(409, e.messages)
+
+        # rollups are bucketed in naive utc
+        start, end = [date.astimezone(timezone.utc).replace(tzinfo=None) if date and date.tzinfo else date
+                      for date in (params.get("start"), params.get("end"))]
+        end = end or datetime.utcnow()
+
+        if params["granularity"] == "hour":
+            start = start or end - timedelta(days=1)
+            if end - start > timedelta(days=settings.SALES_HOURLY_RETENTION_DAYS):
+                return abort(409, {"start": ["Hourly sales are kept for {} days.".format(
+                    settings.SALES_HOURLY_RETENTION_DAYS)]})
+        elif start and end - start > timedelta(days=3660):
+            return abort(409, {"start": ["Range is too long."]})
+
+        user_id = request.environ.get("user_context", {}).get("id")
+        owner = user_id
+        if params["scope"] == "product":
+            owner = params.get("product_id")
+            if not owner or not ProductService.query({"_id": ProductService._prepare_id(owner),
+                                                      "user": ProductService._prepare_id(user_id)}).count():
+                return abort(404, {"desc": "requested object does not exist"})
+
+        series, totals = self.service_klass.series(params["scope"], owner, granularity=params["granularity"],
+                                                   start=start, end=end)
+        schema = self.serializers.get("response")
+        return {"data": schema().dump(series, many=True), "totals": totals}
+
+    def post(self):
+        abort(400)
+
+    def put(self, obj_id=None):
+        abort(400)
+
+    def delete(self, obj_id=None):
+        abort(400)
@@ -1,6 +1,17 @@
-from marshmallow import Schema, EXCLUDE, fields as _fields, validates, ValidationError
+from marshmallow import Schema, EXCLUDE, fields as _fields, validate, validates, ValidationError, pre_load
 
-from src.models import User
+from src.models import User, reference_id
+from src.base.tenant import get_instance_id
+
+
+def reference(name):
+    """ dumps the stored id of a reference field without dereferencing it """
+
+    def serialize(obj):
+        value = reference_id(obj, name)
+        return str(value) if value is not None else None
+
+    return _fields.Function(serialize=serialize, deserialize=lambda value: value, allow_none=True)
 
 
 class ExcludeSchema(Schema):
@@ -41,21 +52,244 @@ class LoginSchema(ExcludeSchema):
 
     @validates("email")
     def validate_email(self, email):
-        if not User.objects.raw({"email": email}).count():
+        query = {"email": email, "deleted": False}
+        if get_instance_id():
+            query["instance_id"] = get_instance_id()
+        if not User.objects.raw(query).count():
             raise ValidationError(message="Invalid email", field_name="email")
 
 
 class LoginResponseSchema(UserResponseSchema):
     auth_token = _fields.String(required=True, allow_none=False)
+    refresh_token = _fields.String(required=True, allow_none=False)
+
+
+class RefreshTokenSchema(ExcludeSchema):
+    refresh_token = _fields.String(required=True, allow_none=False)
+
+
+class LogoutSchema(ExcludeSchema):
+    refresh_token = _fields.String(required=False, allow_none=True)
+    everywhere = _fields.Boolean(required=False, load_default=False)
+
+
+class PriceSchema(ExcludeSchema):
+    value = _fields.Float(required=True, allow_none=False)
+    cost_value = _fields.Float(required=False, allow_none=True)
+    selling_value = _fields.Float(required=False, allow_none=True)
+    discount_value = _fields.Float(required=False, allow_none=True)
+    mrsp_value = _fields.Float(required=False, allow_none=True)
+    profit_margin = _fields.Float(required=False, allow_none=True)
+    currency = reference("currency")
+
+
+class ProductVariantSchema(ExcludeSchema):
+    id = _fields.String(required=False, allow_none=True)
+    name = _fields.String(required=False, allow_none=True)
+    sku = _fields.String(required=False, allow_none=True)
+    prices = _fields.List(_fields.Nested(PriceSchema), required=False)
+    quantity = _fields.Integer(required=True, allow_none=False)
+    attributes = _fields.List(_fields.Raw(), required=False, allow_none=True)
+    available = _fields.Boolean(required=False, allow_none=True)
+    default_currency = reference("default_currency")
+    normalized_price = _fields.Float(required=False, allow_none=True)
+
+
+class ProductStatSchema(ExcludeSchema):
+    units_sold = _fields.Integer(required=False, allow_none=True)
+    total_amount = _fields.Float(required=False, allow_none=True)
+    likes = _fields.Integer(required=False, allow_none=True)
+    views = _fields.Integer(required=False, allow_none=True)
 
 
 class ProductResponseSchema(ExcludeSchema):
     """
 
     """
+    pk = _fields.String(required=False, allow_none=True)
+    name = _fields.String(required=True, allow_none=False)
+    sku = _fields.String(required=False, allow_none=True)
+    code = _fields.String(required=False, allow_none=True)
+    description = _fields.String(required=False, allow_none=True)
+    caption = _fields.String(required=False, allow_none=True)
+    category = reference("category")
+    sub_category = reference("sub_category")
+    location = reference("location")
+    user = reference("user")
+    price = _fields.Nested(PriceSchema, required=False, allow_none=True)
+    discount_price = _fields.Nested(PriceSchema, required=False, allow_none=True)
+    images = _fields.List(_fields.String(), required=False, allow_none=True)
+    quantity = _fields.Integer(required=False, allow_none=True)
+    unlimited_stock = _fields.Boolean(required=False, allow_none=True)
+    tags = _fields.List(_fields.String(), required=False, allow_none=True)
+    variants = _fields.List(_fields.Nested(ProductVariantSchema), required=False, allow_none=True)
+    stats = _fields.Nested(ProductStatSchema, required=False, allow_none=True)
+    visible = _fields.Boolean(required=False, allow_none=True)
+    has_variations = _fields.Boolean(required=False, allow_none=True)
+    distance = _fields.Float(required=False, allow_none=True)
+    normalized_price = _fields.Float(required=False, allow_none=True)
+    date_created = _fields.DateTime(required=False, allow_none=True)
+    last_updated = _fields.DateTime(required=False, allow_none=True)
+
+
+class ProductListSchema(ExcludeSchema):
+    """
+    filters of product listings, prices are in settings.BASE_CURRENCY
+    """
+    category = _fields.String(required=False, allow_none=True)
+    min_price = _fields.Float(required=False, allow_none=True, validate=validate.Range(min=0))
+    max_price = _fields.Float(required=False, allow_none=True, validate=validate.Range(min=0))
+    sort = _fields.String(required=False, allow_none=True, validate=validate.OneOf(["price", "-price"]))
 
 
 class ProductRequestSchema(ExcludeSchema):
     """
 
     """
+    name = _fields.String(required=True, allow_none=False)
+    sku = _fields.String(required=False, allow_none=True)
+    code = _fields.String(required=False, allow_none=True)
+    description = _fields.String(required=False, allow_none=True)
+    caption = _fields.String(required=False, allow_none=True)
+    category = _fields.String(required=False, allow_none=True)
+    sub_category = _fields.String(required=False, allow_none=True)
+    location = _fields.String(required=False, allow_none=True)
+    price = _fields.Nested(PriceSchema, required=False, allow_none=True)
+    discount_price = _fields.Nested(PriceSchema, required=False, allow_none=True)
+    images = _fields.List(_fields.String(), required=False, allow_none=True)
+    quantity = _fields.Integer(required=False, allow_none=True, validate=validate.Range(min=0))
+    unlimited_stock = _fields.Boolean(required=False, allow_none=True)
+    tags = _fields.List(_fields.String(), required=False, allow_none=True)
+    variants = _fields.List(_fields.Nested(ProductVariantSchema), required=False, allow_none=True)
+    visible = _fields.Boolean(required=False, allow_none=True)
+    has_variations = _fields.Boolean(required=False, allow_none=True)
+
+
+class ProductImportSchema(ProductRequestSchema):
+    """
+    A catalog import row. Accepts nested rows (NDJSON) as well as flat ones (CSV), where the price is given as
+    price/cost_price/currency columns and list columns are separated by "|".
+    Categories are referenced by code and resolved by the importer.
+    """
+    sku = _fields.String(required=True, allow_none=False, validate=validate.Length(min=1))
+    category_code = _fields.String(required=False, allow_none=True)
+    sub_category_code = _fields.String(required=False, allow_none=True)
+
+    list_separator = "|"
+
+    @pre_load
+    def normalize_row(self, data, **kwargs):
+        """ drop empty cells, split list columns and nest the flat price columns """
+        data = {key: value.strip() if isinstance(value, str) else value for key, value in data.items()
+                if key is not None}
+        data = {key: value for key, value in data.items() if value not in ("", None)}
+
+        for key in ("tags", "images"):
+            if isinstance(data.get(key), str):
+                data[key] = [item.strip() for item in data[key].split(self.list_separator) if item.strip()]
+
+        if "price" in data and not isinstance(data["price"], dict):
+            price = {"value": data.pop("price"), "currency": data.pop("currency", None)}
+            if "cost_price" in data:
+                price["cost_value"] = data.pop("cost_price")
+            data["price"] = price
+        return data
+
+
+class ProductEventSchema(ExcludeSchema):
+    event = _fields.String(required=True, allow_none=False, validate=validate.OneOf(["view", "like", "unlike"]))
+
+
+class LocationRequestSchema(ExcludeSchema):
+    first_name = _fields.String(required=False, allow_none=True)
+    last_name = _fields.String(required=False, allow_none=True)
+    name = _fields.String(required=False, allow_none=True)
+    phone = _fields.String(required=True, allow_none=False)
+    email = _fields.String(required=False, allow_none=True)
+    city = _fields.String(required=False, allow_none=True)
+    state = _fields.String(required=False, allow_none=True)
+    country = _fields.String(required=False, allow_none=True)
+    street = _fields.String(required=False, allow_none=True)
+    street_line_2 = _fields.String(required=False, allow_none=True)
+    post_code = _fields.String(required=False, allow_none=True)
+    lat = _fields.Float(required=False, allow_none=True, validate=validate.Range(min=-90, max=90))
+    lng = _fields.Float(required=False, allow_none=True, validate=validate.Range(min=-180, max=180))
+    default = _fields.Boolean(required=False, allow_none=True)
+
+
+class LocationResponseSchema(LocationRequestSchema):
+    pk = _fields.String(required=False, allow_none=True)
+    country = reference("country")
+    distance = _fields.Float(required=False, allow_none=True)
+    date_created = _fields.DateTime(required=False, allow_none=True)
+    last_updated = _fields.DateTime(required=False, allow_none=True)
+
+
+class NearbySchema(ExcludeSchema):
+    lat = _fields.Float(required=True, allow_none=False, validate=validate.Range(min=-90, max=90))
+    lng = _fields.Float(required=True, allow_none=False, validate=validate.Range(min=-180, max=180))
+    radius = _fields.Float(required=False, allow_none=True, validate=validate.Range(min=0))
+    limit = _fields.Integer(required=False, load_default=20, validate=validate.Range(min=1, max=100))
+    after_distance = _fields.Float(required=False, allow_none=True)
+    after_id = _fields.String(required=False, allow_none=True)
+
+
+class JobResponseSchema(ExcludeSchema):
+    pk = _fields.String(required=False, allow_none=True)
+    name = _fields.String(required=True, allow_none=False)
+    status = _fields.String(required=True, allow_none=False)
+    attempts = _fields.Integer(required=False, allow_none=True)
+    max_attempts = _fields.Integer(required=False, allow_none=True)
+    progress = _fields.Dict(required=False, allow_none=True)
+    result = _fields.Dict(required=False, allow_none=True)
+    error = _fields.String(required=False, allow_none=True)
+    run_at = _fields.DateTime(required=False, allow_none=True)
+    started_at = _fields.DateTime(required=False, allow_none=True)
+    finished_at = _fields.DateTime(required=False, allow_none=True)
+    date_created = _fields.DateTime(required=False, allow_none=True)
+    last_updated = _fields.DateTime(required=False, allow_none=True)
+
+
+class SalesDashboardSchema(ExcludeSchema):
+    scope = _fields.String(required=False, load_default="seller", validate=validate.OneOf(["seller", "product"]))
+    product_id = _fields.String(required=False, allow_none=True)
+    granularity = _fields.String(required=False, load_default="day", validate=validate.OneOf(["hour", "day"]))
+    start = _fields.DateTime(required=False, allow_none=True)
+    end = _fields.DateTime(required=False, allow_none=True)
+
+
+class SalesBucketSchema(ExcludeSchema):
+    bucket = _fields.DateTime(required=True, allow_none=False)
+    units = _fields.Integer(required=False, allow_none=True)
+    sales = _fields.Integer(required=False, allow_none=True)
+    amounts = _fields.Dict(required=False, allow_none=True)
+
+
+class CartLineSchema(ExcludeSchema):
+    product_id = _fields.String(required=True, allow_none=False)
+    sku = _fields.String(required=False, allow_none=True)
+    quantity = _fields.Integer(required=True, allow_none=False, validate=validate.Range(min=1))
+
+
+class CartQuoteSchema(ExcludeSchema):
+    lines = _fields.List(_fields.Nested(CartLineSchema), required=True, validate=validate.Length(min=1, max=200))
+    currency = _fields.String(required=False, allow_none=True)
+
+
+class CartQuoteLineSchema(ExcludeSchema):
+    product_id = _fields.String(required=True, allow_none=False)
+    sku = _fields.String(required=False, allow_none=True)
+    name = _fields.String(required=False, allow_none=True)
+    quantity = _fields.Integer(required=True, allow_none=False)
+    unit_price = _fields.Float(required=False, allow_none=True)
+    line_total = _fields.Float(required=False, allow_none=True)
+    available = _fields.Boolean(required=True, allow_none=False)
+    available_quantity = _fields.Integer(required=False, allow_none=True)
+    error = _fields.String(required=False, allow_none=True)
+
+
+class CartQuoteResponseSchema(ExcludeSchema):
+    currency = _fields.Dict(required=True, allow_none=False)
+    lines = _fields.List(_fields.Nested(CartQuoteLineSchema), required=True)
+    total = _fields.Float(required=True, allow_none=False)
+    available = _fields.Boolean(required=True, allow_none=False)
@@ -0,0 +1,92 @@
+from ..base.service import ServiceFactory
+from ..base import cache
+from ..models import Category, SubCategory, Product
+from datetime import datetime
+import hashlib
+import json
+import settings
+
+
+BaseCategoryService = ServiceFactory.create_service(Category)
+BaseSubCategoryService = ServiceFactory.create_service(SubCategory)
+
+
+class SubCategoryService(BaseSubCategoryService):
+    """
+
+    """
+
+
+class CategoryService(BaseCategoryService):
+    """
+
+    """
+
+    @classmethod
+    def tree(cls, instance_id):
+        """
+        The category tree of an instance, served from cache. Writes to categories or sub categories through the
+        services bump their collection version, which retires the cached tree; product counts may lag by up to
+        CATEGORY_TREE_TTL_SECONDS.
+
+        :param instance_id: the instance the categories belong to
+        :return: dict with the tree under "data" along with its "etag" and "last_modified" date, the date it was
+            built
+        """
+        store = cache.get_cache()
+        key = cache.make_key("category_tree", instance_id, models=[Category, SubCategory])
+        entry = store.get(key)
+        if entry is None:
+            entry = cls.build_tree(instance_id)
+            store.set(key, entry, ttl=settings.CATEGORY_TREE_TTL_SECONDS)
+        return entry
+
+    @classmethod
+    def build_tree(cls, instance_id):
+        """
+        Builds the Category -> SubCategory hierarchy with product counts in three queries, regardless of the number
+        of nodes: categories, their sub categories, and one aggregation for the counts.
+
+        :param instance_id: the instance the categories belong to
+        :return: dict
+        """
+        node_fields = {"code": 1, "name": 1, "description": 1, "relevance": 1}
+        categories = list(Category._mongometa.collection.find(
+            {"instance_id": instance_id, "deleted": False, "visible": {"$ne": False}}, projection=node_fields,
+            sort=[("relevance", -1), ("name", 1)]))
+        category_ids = [category["_id"] for category in categories]
+
+        sub_categories = list(SubCategory._mongometa.collection.find(
+            {"instance_id": instance_id, "category": {"$in": category_ids}, "deleted": False,
+             "visible": {"$ne": False}},
+            projection=dict(node_fields, category=1), sort=[("name", 1)]))
+
+        counts = {}
+        for row in Product._mongometa.collection.aggregate([
+                {"$match": {"instance_id": instance_id, "category": {"$in": category_ids}, "deleted": False}},
+                {"$group": {"_id": {"category": "$category", "sub_category": "$sub_category"},
+                            "count": {"$sum": 1}}}]):
+            category_id, sub_category_id = row["_id"].get("category"), row["_id"].get("sub_category")
+            counts[category_id] = counts.get(category_id, 0) + row["count"]
+            if sub_category_id:
+                counts[sub_category_id] = counts.get(sub_category_id, 0) + row["count"]
+
+        def node(doc):
+            return {"id": str(doc["_id"]), "code": doc.get("code"), "name": doc.get("name"),
+                    "description": doc.get("description"), "product_count": counts.get(doc["_id"], 0)}
+
+        children = {}
+        for sub_category in sub_categories:
+            children.setdefault(sub_category["category"], []).append(node(sub_category))
+
+        tree = []
+        for category in categories:
+            item = node(category)
+            item["sub_categories"] = children.get(category["_id"], [])
+            tree.append(item)
+
+        # the date of the build rather than of the newest node: that one goes backwards when a node is deleted and
+        # ignores product counts, so If-Modified-Since alone would get a 304 for a changed tree
+        last_modified = datetime.utcnow().replace(microsecond=0)
+        etag = hashlib.sha1(json.dumps(tree, sort_keys=True).encode("utf-8")).hexdigest()
+        return {"data": tree, "etag": etag, "last_modified": last_modified.isoformat()}
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from ..base.service import ServiceFactory
+from ..base import cache
+from ..models import FxRate
+from .job import JobService
+import settings
+
+
+BaseFxService = ServiceFactory.create_service(FxRate)
+
+
+class FxService(BaseFxService):
+    """
+    Exchange rates to settings.BASE_CURRENCY
+    """
+
+    @classmethod
+    def set_rate(cls, currency, rate, renormalize=True):
+        """
+        Record the rate of a currency and queue the recompute of the normalized prices of products priced in it. The
+        cached rate table is only invalidated in this process (and everywhere with the mongo cache backend); the job
+        reads the rates from the collection, so it recomputes with the new rate whichever worker runs it.
+
+        :param currency: currency code
+        :param rate: value of one unit of currency in the base currency
+        :param renormalize: queue the normalize_prices job
+        :return: the queued Job, or None
+        """
+        if currency == settings.BASE_CURRENCY:
+            raise ValueError("the rate of the base currency is always 1")
+        if not rate or rate <= 0:
+            raise ValueError("rate must be positive")
+
+        cls.model_class._mongometa.collection.update_one(
+            {"_id": currency},
+            {"$set": {"rate": float(rate), "last_updated": datetime.utcnow()},
+             "$setOnInsert": {"_cls": FxRate._mongometa.object_name}},
+            upsert=True)
+        cache.invalidate(cls.model_class)
+        if renormalize:
+            return JobService.enqueue("normalize_prices", params={"currency": currency})
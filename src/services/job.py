@@ -0,0 +1,162 @@
+from ..base.service import ServiceFactory
+from ..models import Job
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+import pymongo
+import settings
+
+# queued jobs looked at per round when claiming
+CLAIM_CANDIDATES = 20
+
+
+BaseJobService = ServiceFactory.create_service(Job)
+
+
+class JobService(BaseJobService):
+    """
+    Persistent job queue. Jobs are claimed atomically with find_one_and_update and held under a lease that the
+    running worker keeps extending; a job whose worker died is claimed again once its lease expires.
+
+    Concurrency limits are enforced by the claim itself: a job of a limited name is only claimed together with one of
+    the limit slots of its name, stored in Job.slot under a unique index, so two workers can never both take the last
+    slot.
+    """
+
+    @classmethod
+    def enqueue(cls, name, params=None, user_id=None, max_attempts=3, run_at=None):
+        """
+
+        :param name: name of a registered job, see src.jobs.worker.JOBS
+        :param params: keyword arguments of the job
+        :param user_id: owner of the job, who can see its status
+        :param max_attempts: attempts before the job is marked failed
+        :param run_at: do not run before this date
+        :return: Job
+        """
+        return cls.create(name=name, params=params or {}, user_id=user_id, max_attempts=max_attempts,
+                          run_at=run_at or datetime.utcnow())
+
+    @classmethod
+    def claim(cls, worker_id, names=None, lease_seconds=None, limits=None):
+        """
+        Atomically claim the next runnable job: a queued job that is due, or a running job whose lease expired and
+        that has attempts left. A job whose lease expired on its last attempt (its worker was killed, e.g. out of
+        memory, before it could record the failure) is marked failed instead.
+
+        :param worker_id: id of the claiming worker
+        :param names: only claim jobs with these names
+        :param lease_seconds: how long the job is held before another worker may take it over
+        :param limits: most jobs of a name running at once, by name
+        :return: Job or None
+        """
+        now = datetime.utcnow()
+        collection = cls.model_class._mongometa.collection
+        limits = limits or {}
+        expired = {"status": Job.RUNNING, "lease_expires_at": {"$lt": now}}
+        collection.update_many(dict(expired, **{"$expr": {"$gte": ["$attempts", "$max_attempts"]}}),
+                               {"$set": {"status": Job.FAILED, "finished_at": now, "last_updated": now,
+                                         "error": "lease expired on the last attempt, the worker was lost"},
+                                "$unset": {"lease_expires_at": "", "slot": ""}})
+        if limits:
+            # a job whose lease expired is no longer running as far as limits go, its worker stops it
+            collection.update_many(dict(expired, slot={"$exists": True}), {"$unset": {"slot": ""}})
+
+        claimable = {"$or": [{"status": Job.QUEUED, "run_at": {"$lte": now}},
+                             dict(expired, **{"$expr": {"$lt": ["$attempts", "$max_attempts"]}})]}
+        lease = timedelta(seconds=lease_seconds or settings.JOB_LEASE_SECONDS)
+        update = {"$set": {"status": Job.RUNNING, "worker_id": worker_id, "started_at": now,
+                           "lease_expires_at": now + lease, "last_updated": now},
+                  "$inc": {"attempts": 1}}
+
+        full = set()
+        while True:
+            query = dict(claimable)
+            if names is not None:
+                query["name"] = {"$in": [name for name in names if name not in full]}
+            elif full:
+                query["name"] = {"$nin": list(full)}
+            candidates = list(collection.find(query, projection={"name": 1}, sort=[("run_at", pymongo.ASCENDING)],
+                                              limit=CLAIM_CANDIDATES))
+            if not candidates:
+                return None
+            # candidates claimed by another worker in the meantime no longer match, the next round skips them
+            for candidate in candidates:
+                if candidate["name"] in full:
+                    continue
+                doc = cls._claim_one(dict(claimable, _id=candidate["_id"]), update, candidate["name"],
+                                     limits.get(candidate["name"]))
+                if doc is False:
+                    full.add(candidate["name"])
+                elif doc:
+                    return cls.model_class.from_document(doc)
+
+    @classmethod
+    def _claim_one(cls, query, update, name, limit):
+        """ the claimed document, None if another worker claimed it first, False if its name has no free slot """
+        collection = cls.model_class._mongometa.collection
+        if limit is None:
+            return collection.find_one_and_update(query, update, return_document=pymongo.ReturnDocument.AFTER)
+        for slot in range(limit):
+            try:
+                return collection.find_one_and_update(
+                    query, dict(update, **{"$set": dict(update["$set"], slot="{}:{}".format(name, slot))}),
+                    return_document=pymongo.ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                continue
+        return False
+
+    @classmethod
+    def _update_owned(cls, job, update, leased=False):
+        """
+        update a job only while it is still held by the worker that claimed it
+
+        :param leased: also require the lease to still be valid
+        """
+        now = datetime.utcnow()
+        update.setdefault("$set", {})["last_updated"] = now
+        query = {"_id": job.pk, "worker_id": job.worker_id, "status": Job.RUNNING}
+        if leased:
+            query["lease_expires_at"] = {"$gte": now}
+        result = cls.model_class._mongometa.collection.update_one(query, update)
+        return result.modified_count == 1
+
+    @classmethod
+    def extend_lease(cls, job, lease_seconds=None):
+        """ extend the lease of a running job. Returns False once the lease was lost: expired or taken over """
+        lease = timedelta(seconds=lease_seconds or settings.JOB_LEASE_SECONDS)
+        return cls._update_owned(job, {"$set": {"lease_expires_at": datetime.utcnow() + lease}}, leased=True)
+
+    @classmethod
+    def report_progress(cls, job, progress, lease_seconds=None):
+        """ store progress and extend the lease. Returns False once the lease was lost """
+        lease = timedelta(seconds=lease_seconds or settings.JOB_LEASE_SECONDS)
+        return cls._update_owned(job, {"$set": {"progress": progress,
+                                                "lease_expires_at": datetime.utcnow() + lease}}, leased=True)
+
+    @classmethod
+    def complete(cls, job, result=None):
+        """
+
+        :param job: the claimed job
+        :param result: json serializable result
+        """
+        return cls._update_owned(job, {"$set": {"status": Job.COMPLETED, "result": result or {},
+                                                "finished_at": datetime.utcnow()},
+                                       "$unset": {"lease_expires_at": "", "slot": ""}})
+
+    @classmethod
+    def fail(cls, job, error):
+        """
+        Record a failed attempt. The job is queued again with an exponential backoff until it runs out of attempts.
+
+        :param job: the claimed job
+        :param error: error message
+        """
+        now = datetime.utcnow()
+        if job.attempts < job.max_attempts:
+            delay = timedelta(seconds=settings.JOB_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+            update = {"$set": {"status": Job.QUEUED, "error": error, "run_at": now + delay}}
+        else:
+            update = {"$set": {"status": Job.FAILED, "error": error, "finished_at": now}}
+        update["$unset"] = {"lease_expires_at": "", "slot": ""}
+        return cls._update_owned(job, update)
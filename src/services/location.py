@@ -0,0 +1,77 @@
+from ..base.service import ServiceFactory
+from ..base import cache
+from ..models import Location
+import settings
+
+
+BaseLocationService = ServiceFactory.create_service(Location)
+
+
+class LocationService(BaseLocationService):
+    """
+
+    """
+
+    @classmethod
+    def backfill_points(cls):
+        """
+        set the GeoJSON point of locations saved before it existed, from their lat/lng, so $geoNear finds them.
+        Location.clean only maintains it on save; locations with a missing or out of range lat/lng are left without.
+
+        :return: number of locations updated
+        """
+        collection = cls.model_class._mongometa.collection
+        result = collection.update_many(
+            {"point": {"$exists": False},
+             "lat": {"$type": "number", "$gte": -90, "$lte": 90},
+             "lng": {"$type": "number", "$gte": -180, "$lte": 180}},
+            [{"$set": {"point": {"type": "Point", "coordinates": ["$lng", "$lat"]}}}])
+        if result.modified_count:
+            cache.invalidate(cls.model_class)
+        return result.modified_count
+
+    @classmethod
+    def geo_near(cls, lng, lat, max_distance=None, after_distance=None, query=None):
+        """
+        $geoNear stage over Location.point. Results come out sorted by distance in meters, stored in "distance".
+
+        :param lng: longitude of the origin
+        :param lat: latitude of the origin
+        :param max_distance: radius in meters, defaults to GEO_DEFAULT_RADIUS_METERS
+        :param after_distance: only locations at or beyond this distance, used for paging
+        :param query: extra filter on locations
+        :return: dict
+        """
+        stage = {"near": {"type": "Point", "coordinates": [float(lng), float(lat)]},
+                 "distanceField": "distance",
+                 "spherical": True,
+                 "key": "point",
+                 "maxDistance": float(max_distance or settings.GEO_DEFAULT_RADIUS_METERS)}
+        if after_distance is not None:
+            stage["minDistance"] = float(after_distance)
+        stage["query"] = cls.scoped(query)
+        return {"$geoNear": stage}
+
+    @classmethod
+    def nearest(cls, lng, lat, limit=20, max_distance=None, after_distance=None, after_id=None, query=None):
+        """
+        Locations nearest to a point, paged by distance. Pass the distance and id of the last location of a page as
+        after_distance/after_id to get the next page.
+
+        :return: list of locations, each with a distance attribute in meters
+        """
+        pipeline = [cls.geo_near(lng, lat, max_distance=max_distance, after_distance=after_distance, query=query)]
+        if after_id is not None:
+            after_id = cls._prepare_id(after_id)
+            after_distance = float(after_distance or 0)
+            pipeline.append({"$match": {"$or": [{"distance": {"$gt": after_distance}},
+                                                 {"distance": after_distance, "_id": {"$gt": after_id}}]}})
+        pipeline += [{"$sort": {"distance": 1, "_id": 1}}, {"$limit": int(limit)}]
+
+        locations = []
+        for doc in cls.model_class._mongometa.collection.aggregate(pipeline):
+            distance = doc.pop("distance")
+            location = cls.model_class.from_document(doc)
+            location.distance = distance
+            locations.append(location)
+        return locations
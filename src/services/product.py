@@ -1,22 +1,257 @@
 from ..base.service import ServiceFactory
-from ..models import Product
+from ..base.counters import BufferedCounter
+from ..base import tenant
+from ..models import Product, Currency, FxRate
+from collections import Counter
+from decimal import Decimal, ROUND_HALF_UP
+import pymongo
+from .location import LocationService
+import settings
 
 
 BaseProductService = ServiceFactory.create_service(Product)
 
+# per worker buffer for ProductStat counters, flushed as one bulk_write of $inc operations
+product_stats = BufferedCounter(Product, fields=["stats.views", "stats.likes", "stats.units_sold",
+                                                     "stats.total_amount"],
+                                flush_interval=settings.STATS_FLUSH_INTERVAL_SECONDS,
+                                flush_threshold=settings.STATS_FLUSH_THRESHOLD)
+
 
 class ProductService(BaseProductService):
     """
 
     """
 
+    stat_events = {"view": ("stats.views", 1),
+                   "like": ("stats.likes", 1),
+                   "unlike": ("stats.likes", -1)}
+
     @classmethod
     def register(cls, **kwargs):
         """
+        Create a product. A soft deleted product of the seller with the same sku keeps its sku until archived, it is
+        brought back with the new data instead, as the catalog import does.
 
         :param kwargs:
         :type kwargs:
         :return:
         :rtype:
         """
+        if kwargs.get("sku"):
+            deleted = cls.find_one({"user": kwargs.get("user"), "sku": kwargs["sku"], "deleted": True},
+                                   include_deleted=True)
+            if deleted:
+                return cls.update(deleted, deleted=False, deleted_at=None, **kwargs)
         return cls.create(**kwargs)
+
+    @classmethod
+    def record_event(cls, obj_id, event):
+        """
+        Count a product page event. The counter is buffered and written on the next flush, the product is not loaded:
+        a single count on _id checks it exists in the current tenant.
+
+        :param obj_id: id of the product
+        :param event: one of stat_events
+        :return: False when there is no such product
+        """
+        field, amount = cls.stat_events[event]
+        obj_id = cls._prepare_id(obj_id)
+        if not cls.model_class._mongometa.collection.count_documents(cls.scoped({"_id": obj_id}), limit=1):
+            return False
+        product_stats.incr(obj_id, field, amount)
+        return True
+
+    @classmethod
+    def record_units_sold(cls, obj_id, quantity):
+        """
+
+        :param obj_id: id of the product
+        :param quantity: number of units sold
+        """
+        product_stats.incr(cls._prepare_id(obj_id), "stats.units_sold", quantity)
+
+    @classmethod
+    def listing(cls, category=None, min_price=None, max_price=None, sort=None):
+        """
+        Products filtered by category and price range and sorted by price, prices being compared in the base currency
+        through normalized_price so the query is served by the normalized_price indexes
+
+        :param category: category id
+        :param min_price: lowest normalized price
+        :param max_price: highest normalized price
+        :param sort: "price" or "-price"
+        :return: QuerySet
+        """
+        params = {}
+        if category:
+            params["category"] = cls._prepare_id(category)
+        price_range = {}
+        if min_price is not None:
+            price_range["$gte"] = min_price
+        if max_price is not None:
+            price_range["$lte"] = max_price
+        if price_range:
+            params["normalized_price"] = price_range
+
+        query = cls.query(params)
+        if sort:
+            direction = pymongo.DESCENDING if sort.startswith("-") else pymongo.ASCENDING
+            query = query.order_by([("normalized_price", direction), ("_id", direction)])
+        return query
+
+    # fields a quote needs, nothing else is loaded
+    quote_projection = {"name": 1, "sku": 1, "price.value": 1, "price.currency": 1, "quantity": 1,
+                        "unlimited_stock": 1, "visible": 1, "variants.sku": 1, "variants.name": 1,
+                        "variants.prices.value": 1, "variants.prices.currency": 1, "variants.quantity": 1,
+                        "variants.available": 1, "variants.default_currency": 1}
+
+    @classmethod
+    def quote(cls, lines, currency=None):
+        """
+        Price and check the stock of cart lines. All products are fetched with a single $in query, currencies and
+        rates come from their cached tables. A line is priced in the quote currency when the product has a price in
+        it, otherwise its own price is converted; that unit price is the only value rounded, so line totals and the
+        total add up exactly.
+
+        :param lines: list of dicts with product_id, sku (for products with variants) and quantity
+        :param currency: currency code of the quote, defaults to settings.BASE_CURRENCY
+        :return: dict with the priced lines, total and overall availability
+        """
+        currency = currency or settings.BASE_CURRENCY
+        rates = FxRate.table()
+        currencies = Currency.table()
+
+        ids = list({cls._prepare_id(line["product_id"]) for line in lines})
+        products = {doc["_id"]: doc for doc in cls.model_class._mongometa.collection.find(
+            cls.scoped({"_id": {"$in": ids}}), projection=cls.quote_projection)}
+        # sku -> variant per product, built once and shared by every line of the product
+        variant_skus = {product_id: {variant.get("sku"): variant for variant in doc.get("variants") or []}
+                        for product_id, doc in products.items()}
+
+        requested = Counter()
+        quoted, total, available = [], Decimal(0), True
+        for line in lines:
+            product_id = cls._prepare_id(line["product_id"])
+            result = cls._quote_line(products.get(product_id), variant_skus.get(product_id), line, currency, rates,
+                                     requested)
+            quoted.append(result)
+            if result["line_total"] is not None:
+                total += result.pop("_line_total")
+            available = available and result["available"]
+
+        return {"currency": currencies.get(currency) or {"code": currency},
+                "lines": quoted,
+                "total": float(total),
+                "available": available}
+
+    @classmethod
+    def _quote_line(cls, product, variants, line, currency, rates, requested):
+        quantity = int(line["quantity"])
+        result = {"product_id": str(line["product_id"]), "sku": line.get("sku"), "quantity": quantity,
+                  "name": None, "unit_price": None, "line_total": None, "available": False,
+                  "available_quantity": 0, "error": None}
+        if not product or product.get("visible") is False:
+            result["error"] = "product not found"
+            return result
+        result["name"] = product.get("name")
+
+        if variants:
+            variant = variants.get(line.get("sku"))
+            if variant is None:
+                result["error"] = "unknown variant sku"
+                return result
+            prices = variant.get("prices") or []
+            default_currency = variant.get("default_currency")
+            stock = None if product.get("unlimited_stock") else (variant.get("quantity") or 0)
+            if variant.get("available") is False:
+                stock = 0
+            if variant.get("name"):
+                result["name"] = "{} ({})".format(product.get("name"), variant["name"])
+        else:
+            prices = [product["price"]] if product.get("price") else []
+            default_currency = None
+            stock = None if product.get("unlimited_stock") else (product.get("quantity") or 0)
+
+        unit_price = cls._unit_price(prices, default_currency, currency, rates)
+        if unit_price is None:
+            result["error"] = "no price in {}".format(currency)
+        else:
+            line_total = unit_price * quantity
+            result.update(unit_price=float(unit_price), line_total=float(line_total), _line_total=line_total)
+
+        # several lines of a cart may take from the same stock
+        key = (product["_id"], line.get("sku"))
+        requested[key] += quantity
+        if stock is None:
+            result.update(available=unit_price is not None, available_quantity=None)
+        else:
+            remaining = max(stock - (requested[key] - quantity), 0)
+            result.update(available=unit_price is not None and requested[key] <= stock,
+                          available_quantity=remaining)
+        return result
+
+    @staticmethod
+    def _unit_price(prices, default_currency, currency, rates):
+        """ unit price in currency: a price in that currency, else the default (or first) price converted """
+        cent = Decimal("0.01")
+        for price in prices:
+            if price.get("currency") == currency and price.get("value") is not None:
+                return Decimal(str(price["value"])).quantize(cent, rounding=ROUND_HALF_UP)
+
+        price = next((price for price in prices if price.get("currency") == default_currency),
+                     prices[0] if prices else None)
+        if not price or price.get("value") is None:
+            return None
+        from_rate, to_rate = rates.get(price.get("currency")), rates.get(currency)
+        if not from_rate or not to_rate:
+            return None
+        value = Decimal(str(price["value"])) * Decimal(str(from_rate)) / Decimal(str(to_rate))
+        return value.quantize(cent, rounding=ROUND_HALF_UP)
+
+    @classmethod
+    def find_by_variant_sku(cls, sku):
+        """
+        The products holding a variant with this sku, served by the multikey index on variants.sku. Variant skus are
+        only unique within a product, several products (of different sellers) may share one.
+
+        :param sku: variant sku
+        :return: list of (product, variant), empty when no variant has the sku
+        """
+        return [(product, product.variant_index.find(sku=sku))
+                for product in cls.query({"variants.sku": sku}).order_by([("_id", 1)])]
+
+    @classmethod
+    def near(cls, lng, lat, limit=20, max_distance=None, after_distance=None, after_id=None):
+        """
+        Products sold from locations within max_distance of a point, nearest first. Runs as a single aggregation:
+        $geoNear on locations joined to products through the Product.location index.
+        Pass the distance and id of the last product of a page as after_distance/after_id to get the next page.
+
+        :return: list of products, each with a distance attribute in meters
+        """
+        pipeline = [LocationService.geo_near(lng, lat, max_distance=max_distance, after_distance=after_distance),
+                    {"$project": {"distance": 1}},
+                    {"$lookup": {"from": cls.model_class._mongometa.collection_name,
+                                 "localField": "_id",
+                                 "foreignField": "location",
+                                 "as": "product"}},
+                    {"$unwind": "$product"},
+                    {"$match": {"product.deleted": False, "product.visible": {"$ne": False}}}]
+        instance_id = tenant.get_instance_id()
+        if instance_id:
+            pipeline[-1]["$match"]["product.instance_id"] = instance_id
+        if after_id is not None:
+            after_id = cls._prepare_id(after_id)
+            after_distance = float(after_distance or 0)
+            pipeline.append({"$match": {"$or": [{"distance": {"$gt": after_distance}},
+                                                 {"distance": after_distance, "product._id": {"$gt": after_id}}]}})
+        pipeline += [{"$sort": {"distance": 1, "product._id": 1}}, {"$limit": int(limit)}]
+
+        products = []
+        # $geoNear must be the first stage, so this runs on the raw collection rather than a QuerySet
+        for doc in LocationService.model_class._mongometa.collection.aggregate(pipeline):
+            product = cls.model_class.from_document(doc["product"])
+            product.distance = doc["distance"]
+            products.append(product)
+        return products
@@ -0,0 +1,231 @@
+from collections import defaultdict, Counter
+from datetime import datetime, timedelta
+import re
+import uuid
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ..base.service import ServiceFactory
+from ..base import tenant
+from ..models import SaleEvent, SalesRollup, Product
+from .product import ProductService, product_stats
+import settings
+
+
+BaseSalesService = ServiceFactory.create_service(SaleEvent)
+
+# currency codes become field names of SalesRollup.amounts, "." or "$" would break the update path
+CURRENCY_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,16}$")
+
+# fields of an event needed to add it to the rollups
+ROLLUP_FIELDS = {"product": 1, "seller": 1, "quantity": 1, "amount": 1, "currency": 1, "sold_at": 1, "instance_id": 1}
+
+
+def truncate(date, granularity):
+    """ start of the hour or day bucket holding date """
+    date = date.replace(minute=0, second=0, microsecond=0)
+    return date.replace(hour=0) if granularity == SalesRollup.DAY else date
+
+
+class SalesService(BaseSalesService):
+    """
+    Sales events and their rollups. Every recorded sale adds to the hourly and daily buckets of its product and of
+    its seller, so dashboard queries read one document per bucket whatever the number of sales.
+
+    Events are inserted marked as pending and unmarked once added to the rollups, so a failure in between is
+    recovered: retrying record_sales rolls up the pending duplicates of its order lines, and the roll_up_sales job
+    rolls up whatever is left. An event is claimed before being added, so two processes never add the same one; only
+    a process dying after adding its claimed events but before unmarking them can get them added twice, once their
+    claim has gone stale.
+    """
+
+    bucket_sizes = {SalesRollup.HOUR: timedelta(hours=1), SalesRollup.DAY: timedelta(days=1)}
+
+    @classmethod
+    def record_sale(cls, product_id, quantity, amount, currency=None, variant_sku=None, order_id=None, sold_at=None):
+        """
+
+        :param product_id: id of the product sold
+        :param quantity: number of units sold
+        :param amount: total paid for the units
+        :param currency: currency code of amount
+        :param variant_sku: sku of the variant sold
+        :param order_id: id of the order, a line recorded twice for the same order is only counted once. Lines
+            without one are counted every time they are recorded, retries included
+        :param sold_at: date of the sale, defaults to now
+        :return: number of sales recorded
+        """
+        return cls.record_sales([dict(product=product_id, quantity=quantity, amount=amount, currency=currency,
+                                      variant_sku=variant_sku, order_id=order_id, sold_at=sold_at)])
+
+    @classmethod
+    def record_sales(cls, sales):
+        """
+        Record a batch of sales: one insert for the events, one query for the sellers of the products and one
+        bulk_write of $inc upserts for the rollups.
+
+        :raises ValueError: a product is unknown or a currency code is not alphanumeric
+
+        :param sales: list of dicts with the arguments of record_sale
+        :return: number of sales recorded, duplicates of already recorded order lines are skipped
+        """
+        if not sales:
+            return 0
+        instance_id = tenant.get_instance_id()
+        now = datetime.utcnow()
+
+        product_ids = {ProductService._prepare_id(sale["product"]) for sale in sales}
+        sellers = {doc["_id"]: doc["user"] for doc in Product._mongometa.collection.find(
+            ProductService.scoped({"_id": {"$in": list(product_ids)}}, include_deleted=True), projection={"user": 1})}
+
+        events = []
+        for sale in sales:
+            product_id = ProductService._prepare_id(sale["product"])
+            if product_id not in sellers:
+                raise ValueError("unknown product {}".format(product_id))
+            if sale.get("currency") is not None and not CURRENCY_PATTERN.match(str(sale["currency"])):
+                raise ValueError("invalid currency {}".format(sale["currency"]))
+            event = {"_cls": SaleEvent._mongometa.object_name, "product": product_id, "seller": sellers[product_id],
+                     "quantity": int(sale.get("quantity") or 1), "amount": float(sale.get("amount") or 0),
+                     "sold_at": sale.get("sold_at") or now, "rollup": SaleEvent.ROLLUP_PENDING, "date_created": now}
+            for name in ("variant_sku", "order_id", "currency"):
+                if sale.get(name) is not None:
+                    event[name] = sale[name]
+            if instance_id:
+                event["instance_id"] = instance_id
+            events.append(event)
+
+        recorded, duplicates = events, []
+        try:
+            cls.model_class._mongometa.collection.insert_many(events, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", []) if error.get("code") == 11000}
+            if len(failed) != len(e.details.get("writeErrors", [])):
+                raise
+            recorded = [event for index, event in enumerate(events) if index not in failed]
+            duplicates = [events[index]["order_id"] for index in failed]
+
+        if not recorded and not duplicates:
+            return 0
+        query = {"_id": {"$in": [event["_id"] for event in recorded]}}
+        if duplicates:
+            # a previous attempt may have inserted these lines and failed before rolling them up
+            query = {"$or": [query, {"instance_id": instance_id, "order_id": {"$in": duplicates}}]}
+        cls.roll_up(query)
+        return len(recorded)
+
+    @classmethod
+    def roll_up(cls, query):
+        """
+        claim the pending events matching query, add them to the rollups and to the product stats, then unmark them.
+        The claim is released if adding fails, so the events can be rolled up again.
+
+        :return: number of events rolled up
+        """
+        collection = cls.model_class._mongometa.collection
+        claim = uuid.uuid4().hex
+        result = collection.update_many(dict(query, rollup=SaleEvent.ROLLUP_PENDING),
+                                        {"$set": {"rollup": claim, "rollup_claimed_at": datetime.utcnow()}})
+        if not result.modified_count:
+            return 0
+
+        events = list(collection.find({"rollup": claim}, projection=ROLLUP_FIELDS))
+        try:
+            cls._add_to_rollups(events)
+        except Exception:
+            collection.update_many({"rollup": claim}, {"$set": {"rollup": SaleEvent.ROLLUP_PENDING},
+                                                       "$unset": {"rollup_claimed_at": ""}})
+            raise
+        collection.update_many({"rollup": claim}, {"$unset": {"rollup": "", "rollup_claimed_at": ""}})
+        for event in events:
+            product_stats.incr(event["product"], "stats.units_sold", event["quantity"])
+            product_stats.incr(event["product"], "stats.total_amount", event["amount"])
+        return len(events)
+
+    @classmethod
+    def roll_up_pending(cls, stale_after=300, batch_size=1000, progress=None):
+        """
+        Roll up the events left pending by a failed record_sales, and those whose claim is older than stale_after
+        seconds because the process holding it died. Run periodically by the roll_up_sales job, e.g. from cron with
+        "python admin.py enqueue roll_up_sales".
+
+        :return: stats dict
+        """
+        collection = cls.model_class._mongometa.collection
+        stale = datetime.utcnow() - timedelta(seconds=stale_after)
+        released = collection.update_many({"rollup": {"$exists": True, "$ne": SaleEvent.ROLLUP_PENDING},
+                                           "rollup_claimed_at": {"$lt": stale}},
+                                          {"$set": {"rollup": SaleEvent.ROLLUP_PENDING},
+                                           "$unset": {"rollup_claimed_at": ""}})
+        stats = {"released": released.modified_count, "rolled_up": 0}
+        while True:
+            ids = [doc["_id"] for doc in collection.find({"rollup": SaleEvent.ROLLUP_PENDING}, projection={"_id": 1},
+                                                         limit=batch_size)]
+            if not ids:
+                return stats
+            stats["rolled_up"] += cls.roll_up({"_id": {"$in": ids}})
+            if progress:
+                progress(dict(stats))
+
+    @classmethod
+    def _add_to_rollups(cls, events):
+        """ coalesce the events per bucket and apply them in a single unordered bulk_write """
+        increments = defaultdict(Counter)
+        for event in events:
+            for scope, owner in ((SalesRollup.PRODUCT, event["product"]), (SalesRollup.SELLER, event["seller"])):
+                for granularity in cls.bucket_sizes:
+                    counts = increments[(event.get("instance_id"), scope, owner, granularity,
+                                         truncate(event["sold_at"], granularity))]
+                    counts["units"] += event["quantity"]
+                    counts["sales"] += 1
+                    counts["amounts.{}".format(event.get("currency") or "none")] += event["amount"]
+
+        retention = timedelta(days=settings.SALES_HOURLY_RETENTION_DAYS)
+        operations = []
+        for (instance_id, scope, owner, granularity, bucket), counts in increments.items():
+            on_insert = {"_cls": SalesRollup._mongometa.object_name}
+            if granularity == SalesRollup.HOUR:
+                on_insert["expires_at"] = bucket + retention
+            operations.append(UpdateOne({"instance_id": instance_id, "scope": scope, "owner": owner,
+                                         "granularity": granularity, "bucket": bucket},
+                                        {"$inc": dict(counts), "$setOnInsert": on_insert}, upsert=True))
+        if operations:
+            SalesRollup._mongometa.collection.bulk_write(operations, ordered=False)
+
+    @classmethod
+    def series(cls, scope, owner, granularity=SalesRollup.DAY, start=None, end=None):
+        """
+        Sales per bucket between start and end, read from the rollups only. Buckets without sales are filled with
+        zeros so the series is continuous.
+
+        :param scope: SalesRollup.PRODUCT or SalesRollup.SELLER
+        :param owner: id of the product or seller
+        :param granularity: SalesRollup.HOUR or SalesRollup.DAY
+        :param start: first date, defaults to 90 days before end
+        :param end: last date, defaults to now
+        :return: (series, totals)
+        """
+        step = cls.bucket_sizes[granularity]
+        end = truncate(end or datetime.utcnow(), granularity)
+        start = truncate(start or end - timedelta(days=90), granularity)
+
+        found = {doc["bucket"]: doc for doc in SalesRollup._mongometa.collection.find(
+            {"instance_id": tenant.get_instance_id(), "scope": scope, "owner": cls._prepare_id(owner),
+             "granularity": granularity, "bucket": {"$gte": start, "$lte": end}},
+            projection={"bucket": 1, "units": 1, "sales": 1, "amounts": 1})}
+
+        series = []
+        totals = {"units": 0, "sales": 0, "amounts": Counter()}
+        bucket = start
+        while bucket <= end:
+            doc = found.get(bucket) or {}
+            point = {"bucket": bucket, "units": doc.get("units", 0), "sales": doc.get("sales", 0),
+                     "amounts": doc.get("amounts") or {}}
+            totals["units"] += point["units"]
+            totals["sales"] += point["sales"]
+            totals["amounts"].update(point["amounts"])
+            series.append(point)
+            bucket += step
+        totals["amounts"] = dict(totals["amounts"])
+        return series, totals
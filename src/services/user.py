@@ -1,6 +1,12 @@
 from ..base.service import ServiceFactory
-from ..models import User
-from pprint import pprint
+from ..base.revocation import get_revocations
+from ..base import tenant
+from ..models import User, REFRESH_TOKEN
+import jwt
+import logging
+import settings
+
+logger = logging.getLogger(__name__)
 
 
 BaseUserService = ServiceFactory.create_service(User)
@@ -21,7 +27,61 @@ class UserService(BaseUserService):
         :rtype:
         """
 
-        pprint(kwargs)
+        logger.info("registering account", extra={"email": kwargs.get("email")})
         password = kwargs.pop("password")
         user = cls.create(**kwargs)
         return user.set_password(password)
+
+    @classmethod
+    def refresh(cls, refresh_token):
+        """
+        Exchange a refresh token for the user it was issued to. The refresh token is revoked, so every refresh token
+        is only used once and a stolen one stops working as soon as the legitimate client refreshes.
+
+        :param refresh_token: encoded refresh token
+        :return: User, to issue the new pair of tokens from
+        :raises ValueError: the token is invalid, expired, revoked or its user is gone
+        """
+        try:
+            claims = jwt.decode(refresh_token, settings.JWT_SECRET_KEY, algorithms=settings.JWT_ALGORITHM)
+        except jwt.InvalidTokenError as e:
+            raise ValueError(str(e))
+
+        revocations = get_revocations()
+        if claims.get("type") != REFRESH_TOKEN or not claims.get("jti") or revocations.is_revoked(claims):
+            raise ValueError("invalid refresh token")
+
+        with tenant.tenant_scope(claims.get("instance_id")):
+            try:
+                user = cls.get(claims.get("id"))
+            except cls.model_class.DoesNotExist:
+                raise ValueError("user does not exist")
+
+        # the insert is atomic, of two concurrent refreshes with the same token only one succeeds
+        if not revocations.revoke(claims["jti"], claims["exp"]):
+            raise ValueError("invalid refresh token")
+        return user
+
+    @classmethod
+    def logout(cls, claims, refresh_token=None, everywhere=False):
+        """
+        Revoke the access token with these claims, and the refresh token of the session when given
+
+        :param claims: claims of the access token of the request
+        :param refresh_token: encoded refresh token of the same session
+        :param everywhere: revoke every token of the user instead
+        """
+        revocations = get_revocations()
+        if everywhere:
+            revocations.revoke_user(claims.get("id"))
+            return
+
+        revocations.revoke(claims["jti"], claims["exp"])
+        if refresh_token:
+            try:
+                refresh_claims = jwt.decode(refresh_token, settings.JWT_SECRET_KEY,
+                                            algorithms=settings.JWT_ALGORITHM)
+            except jwt.InvalidTokenError:
+                return
+            if refresh_claims.get("id") == claims.get("id") and refresh_claims.get("jti"):
+                revocations.revoke(refresh_claims["jti"], refresh_claims["exp"])